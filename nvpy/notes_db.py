@@ -3,32 +3,82 @@
 # new BSD license
 
 import codecs
-import copy
 import glob
+from itertools import izip
 import os
-import json
 import logging
+from multiprocessing.pool import ThreadPool
 from Queue import Queue, Empty
 import re
+import stat
+from notes_history import NoteHistory
+from notes_index import WordIndex, TrigramIndex, regexp_query
+from notes_store import open_store, Journal, SyncCursor, text_splice, ReadError, WriteError
 import simplenote
 simplenote.NOTE_FETCH_LENGTH=100
 from simplenote import Simplenote
 
 from threading import Thread
 import time
+import txt_watcher
 import utils
 
 ACTION_SAVE = 0
 ACTION_SYNC_PARTIAL_TO_SERVER = 1
 ACTION_SYNC_PARTIAL_FROM_SERVER = 2 # UNUSED.
 
+# a full sync gets the complete note list from the server at least this
+# often, otherwise only the notes that changed since the previous sync.
+# notes that were deleted on the server only show up in the complete list.
+FULL_NOTE_LIST_INTERVAL_S = 24 * 3600
+
 class SyncError(RuntimeError):
     pass
 
-class ReadError(RuntimeError):
-    pass
+def new_note(content, timestamp):
+    """Return a new note dict, that has not been saved or synced yet.
+    """
+
+    # note has no internal key yet.
+    return {
+            'content' : content,
+            'modifydate' : timestamp,
+            'createdate' : timestamp,
+            'savedate' : 0, # never been written to disc
+            'syncdate' : 0, # never been synced with server
+            'tags' : []
+            }
+
+class NoteRevision(dict):
+    """Read-only snapshot of a note, see NotesDB.helper_note_revision().
+
+    The main thread never changes a value of a note in place, it only
+    replaces values. A shallow copy is therefore a stable snapshot that the
+    worker threads can use without copying the content.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('NoteRevision is read-only')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+class NoteRow(object):
+    """One note in the result of a search, see NotesDB.helper_result_row().
+
+    Rows are shared between searches, so nobody may change them.
+    """
+
+    __slots__ = ('key', 'note', 'tagfound')
+
+    def __init__(self, key, note, tagfound):
+        self.key = key
+        self.note = note
+        self.tagfound = tagfound
 
-class WriteError(RuntimeError):
+class SearchCancelled(Exception):
+    """Raised inside a background search when a newer search has been
+    requested in the meantime.
+    """
     pass
 
 class NotesDB(utils.SubjectMixin):
@@ -50,67 +100,117 @@ class NotesDB(utils.SubjectMixin):
             os.mkdir(config.txt_path)
         
         now = time.time()    
-        # now read all .json files from disk
-        fnlist = glob.glob(self.helper_key_to_fname('*'))
+        # now read all notes from disk
+        self.store = open_store(config)
+        loaded_notes = self.store.load()
+        for n in loaded_notes.itervalues():
+            utils.normalise_note(n)
+
         txtlist = glob.glob(unicode(self.config.txt_path + '/*.txt', 'utf-8'))
         txtlist += glob.glob(unicode(self.config.txt_path + '/*.mkdn', 'utf-8'))
 
         # removing json files and force full full sync if using text files
         # and none exists and json files are there
-        if self.config.notes_as_txt and not txtlist and fnlist:
+        if self.config.notes_as_txt and not txtlist and loaded_notes:
             logging.debug('Forcing resync: using text notes, first usage')
-            for fn in fnlist:
-                os.unlink(fn)
-            fnlist = []
+            with self.store.transaction():
+                for localkey in loaded_notes:
+                    self.store.delete(localkey)
+            loaded_notes = {}
+
+        # dict used as set of the txt notes that don't have a note yet
+        txtset = dict.fromkeys(txtlist)
 
         self.notes = {}
+        # inverted indices used to speed up gstyle and regexp searching
+        self.word_index = WordIndex()
+        self.trigram_index = TrigramIndex()
+        # incremented whenever any note changes. this is used to invalidate
+        # the results of the previous search.
+        self.notes_serial = 0
+        self.last_gstyle_filter = None
+        # key -> (content, lowercased content) for case insensitive search
+        self.lowered_content = {}
+        # dicts used as sets of the keys of notes that have to be saved to
+        # disc, and synced to the server. see helper_mark_dirty().
+        self.keys_to_save = {}
+        self.keys_to_sync = {}
+        # keys of notes that have changed since they were last written to
+        # the store. a store with full-text search can't find these yet.
+        self.unsaved_keys = {}
+        # key -> NoteRevision of the current version of that note, see
+        # helper_note_revision().
+        self.revisions = {}
+        # key -> (NoteRow with tagfound 0, NoteRow with tagfound 1)
+        self.result_rows = {}
         if self.config.notes_as_txt:
+            # local key -> name of the text file of that note
             self.titlelist = {}
+            # name -> (size, mtime) of the text files we wrote ourselves,
+            # so that the watcher can tell them from changes by other programs.
+            self.txt_written = {}
 
-        for fn in fnlist:
+        for localkey, n in loaded_notes.items():
             try:
-                n = json.load(open(fn, 'rb'))
                 if self.config.notes_as_txt:
                     nt = utils.get_note_title_file(n)
                     tfn = os.path.join(self.config.txt_path, nt)
-                    if os.path.isfile(tfn):
-                        self.titlelist[n.get('key')] = nt
-                        txtlist.remove(tfn)
-                        if os.path.getmtime(tfn) > os.path.getmtime(fn):
-                            logging.debug('Text note was changed: %s' % (fn,))
+                    # one stat gives us both existence and mtime
+                    try:
+                        tst = os.stat(tfn)
+                    except OSError:
+                        tst = None
+
+                    if tst is not None and stat.S_ISREG(tst.st_mode):
+                        self.titlelist[localkey] = nt
+                        txtset.pop(tfn, None)
+                        if tst.st_mtime > self.store.get_mtime(localkey):
+                            logging.debug('Text note was changed: %s' % (localkey,))
                             with codecs.open(tfn, mode='rb', encoding='utf-8') as f:  
                                 c = f.read()
 
                             n['content'] = c
-                            n['modifydate'] = os.path.getmtime(tfn)
+                            n['modifydate'] = tst.st_mtime
+                            self.unsaved_keys[localkey] = True
                     else:
-                        logging.debug('Deleting note : %s' % (fn,))
+                        logging.debug('Deleting note : %s' % (localkey,))
                         if not self.config.simplenote_sync:
-                            os.unlink(fn)
+                            self.store.delete(localkey)
                             continue
                         else:
                             n['deleted'] = 1
                             n['modifydate'] = now
 
             except IOError, e:
-                logging.error('NotesDB_init: Error opening %s: %s' % (fn, str(e)))
+                logging.error('NotesDB_init: Error opening %s: %s' % (tfn, str(e)))
                 raise ReadError ('Error opening note file')
 
             except ValueError, e:
-                logging.error('NotesDB_init: Error reading %s: %s' % (fn, str(e)))
+                logging.error('NotesDB_init: Error reading %s: %s' % (tfn, str(e)))
                 raise ReadError ('Error reading note file')
 
             else:
                 # we always have a localkey, also when we don't have a note['key'] yet (no sync)
-                localkey = os.path.splitext(os.path.basename(fn))[0]
                 self.notes[localkey] = n
                 # we maintain in memory a timestamp of the last save
                 # these notes have just been read, so at this moment
                 # they're in sync with the disc.
                 n['savedate'] = now
+
+        # the journal has the changes that a previous session could not
+        # save anymore. see helper_journal().
+        self.journal = Journal(self.db_path)
+        # key -> content as it is in the journal, see helper_journal_content()
+        self.journal_base = {}
+        nreplayed = self.helper_replay_journal(self.journal.replay())
+        if nreplayed:
+            logging.info('NotesDB_init: Recovered unsaved changes to %d notes from journal' % (nreplayed,))
+
+        # earlier versions of the notes, see get_note_revisions()
+        self.history = NoteHistory(self.db_path, self.config.history_revisions)
         
         if self.config.notes_as_txt:
-            for fn in txtlist:
+            for fn in [fn for fn in txtlist if fn in txtset]:
                 logging.debug('New text note found : %s' % (fn),)
                 tfn = os.path.join(self.config.txt_path, fn)
                 try:
@@ -133,19 +233,54 @@ class NotesDB(utils.SubjectMixin):
 
                     os.unlink(tfn)
 
+        # index all notes we have just read, and find the ones that still
+        # have to be saved or synced. after this, we keep track of changes
+        # as they happen.
+        for k,n in self.notes.items():
+            if not self.store.fts:
+                self.helper_reindex_note(k)
+
+            savedate = n.get('savedate')
+            if n.get('modifydate') > savedate or \
+               n.get('syncdate') > savedate:
+                self.keys_to_save[k] = True
+
+            if n.get('modifydate', -1) > n.get('syncdate', -1):
+                self.keys_to_sync[k] = True
 
         # save and sync queue
         self.q_save = Queue()
         self.q_save_res = Queue()
+        # number of saves put on the queue of which we have not seen the
+        # result yet. only used by the main thread.
+        self.saves_in_flight = 0
 
         thread_save = Thread(target=self.worker_save)
         thread_save.setDaemon(True)
         thread_save.start()
 
+        # search queue. every search request gets a new generation number,
+        # only the search with the latest generation is of any interest.
+        self.search_generation = 0
+        self.q_search = Queue()
+        self.q_search_res = Queue()
+
+        thread_search = Thread(target=self.worker_search)
+        thread_search.setDaemon(True)
+        thread_search.start()
+
         # initialise the simplenote instance we're going to use
         # this does not yet need network access
         if self.config.simplenote_sync:
             self.simplenote = Simplenote(config.sn_username, config.sn_password)
+            # keep a connection for each of sync_full's threads
+            self.simplenote.pool.max_idle = max(self.simplenote.pool.max_idle, config.sync_concurrency)
+            # where the previous full sync left off, see sync_full()
+            self.sync_cursor = SyncCursor(self.db_path)
+            # the full sync that is running in the background, see
+            # sync_full_threaded(), and its progress messages.
+            self.sync_full_job = None
+            self.q_sync_full = Queue()
         
             # we'll use this to store which notes are currently being synced by
             # the background thread, so we don't add them anew if they're still
@@ -163,6 +298,14 @@ class NotesDB(utils.SubjectMixin):
             thread_sync = Thread(target=self.worker_sync)
             thread_sync.setDaemon(True)
             thread_sync.start()
+
+        # from now on, we keep up with changes to the text files as they
+        # happen, see process_txt_changes().
+        if self.config.notes_as_txt:
+            self.txt_watcher = txt_watcher.open_watcher(self.config.txt_path)
+
+        else:
+            self.txt_watcher = None
         
     def create_note(self, title):
         # need to get a key unique to this database. not really important
@@ -173,17 +316,11 @@ class NotesDB(utils.SubjectMixin):
             
         timestamp = time.time()
             
-        # note has no internal key yet.
-        new_note = {
-                    'content' : title,
-                    'modifydate' : timestamp,
-                    'createdate' : timestamp,
-                    'savedate' : 0, # never been written to disc
-                    'syncdate' : 0, # never been synced with server
-                    'tags' : []
-                    }
-        
-        self.notes[new_key] = new_note
+        self.notes[new_key] = new_note(title, timestamp)
+        self.helper_reindex_note(new_key)
+        self.helper_mark_dirty(new_key)
+        self.helper_journal(new_key, 'create', value=title)
+        self.journal_base[new_key] = title
         
         return new_key
     
@@ -191,8 +328,11 @@ class NotesDB(utils.SubjectMixin):
         n = self.notes[key]
         n['deleted'] = 1
         n['modifydate'] = time.time()
+        self.helper_reindex_note(key)
+        self.helper_mark_dirty(key)
+        self.helper_journal(key, 'delete')
 
-    def filter_notes(self, search_string=None):
+    def filter_notes(self, search_string=None, generation=None):
         """Return list of notes filtered with search string.
 
         Based on the search mode that has been selected in self.config,
@@ -201,6 +341,8 @@ class NotesDB(utils.SubjectMixin):
 
         @param search_string: String that will be used for searching.
          Different meaning depending on the search mode.
+        @param generation: Search generation when called by worker_search.
+         SearchCancelled is raised as soon as a newer search is requested.
         @return: notes filtered with selected search mode and sorted according
         to configuration. Two more elements in tuple: a regular expression
         that can be used for highlighting strings in the text widget; the
@@ -208,9 +350,12 @@ class NotesDB(utils.SubjectMixin):
         """
 
         if self.config.search_mode == 'regexp':
-            filtered_notes, match_regexp, active_notes = self.filter_notes_regexp(search_string)
+            filtered_notes, match_regexp, active_notes = self.filter_notes_regexp(search_string, generation)
         else:
-            filtered_notes, match_regexp, active_notes = self.filter_notes_gstyle(search_string)
+            filtered_notes, match_regexp, active_notes = self.filter_notes_gstyle(search_string, generation)
+
+        if self._helper_search_cancelled(generation):
+            raise SearchCancelled()
 
         if self.config.sort_mode == 0:
             if self.config.pinned_ontop == 0:
@@ -222,7 +367,7 @@ class NotesDB(utils.SubjectMixin):
         else:
             if self.config.pinned_ontop == 0:
                 # last modified on top
-                filtered_notes.sort(key=lambda o: -float(o.note.get('modifydate', 0)))
+                filtered_notes.sort(key=lambda o: -o.note.get('modifydate', 0))
             else:
                 filtered_notes.sort(utils.sort_by_modify_date_pinned, reverse=True)
 
@@ -286,18 +431,103 @@ class NotesDB(utils.SubjectMixin):
 
 
 
-    def filter_notes_gstyle(self, search_string=None):
+    def _helper_lowered_content(self, k, c):
+        """Return lowercased version of content c of note k.
+
+        The result is cached until the content of the note changes, so that
+        case insensitive searching does not have to lowercase all notes for
+        every search.
+        """
+
+        cached = self.lowered_content.get(k)
+        # the cached version is only valid for this exact content object
+        if cached is not None and cached[0] is c:
+            return cached[1]
+
+        lc = c.lower()
+        self.lowered_content[k] = (c, lc)
+        return lc
+
+    def _helper_gstyle_refines(self, old_pats, new_pats):
+        """Return True if the notes matching new_pats are guaranteed to be a
+        subset of the notes matching old_pats.
+
+        This is the case if every old tag pattern is a prefix of a new tag
+        pattern, and every old (multi-)word pattern is contained in a new
+        (multi-)word pattern.
+
+        @param old_pats: [tag_pats, multi_word_pats, single_word_pats]
+        @param new_pats: same structure as old_pats.
+        """
+
+        for otp in old_pats[0]:
+            if next((tp for tp in new_pats[0] if tp.startswith(otp)), None) is None:
+                return False
+
+        old_msword_pats = old_pats[1] + old_pats[2]
+        new_msword_pats = new_pats[1] + new_pats[2]
+        if not self.config.case_sensitive:
+            old_msword_pats = [p.lower() for p in old_msword_pats]
+            new_msword_pats = [p.lower() for p in new_msword_pats]
+
+        for op in old_msword_pats:
+            if next((p for p in new_msword_pats if op in p), None) is None:
+                return False
+
+        return True
+
+    def filter_notes_threaded(self, search_string=None):
+        """Request a search by the background search worker.
+
+        Any search that is still in progress is abandoned. Use
+        get_filter_result() to pick up the result.
+
+        @returns: generation number of this search.
+        """
+
+        self.search_generation += 1
+        o = utils.KeyValueObject(generation=self.search_generation,
+                                 search_string=search_string)
+        self.q_search.put(o)
+        return o.generation
+
+    def get_filter_result(self):
+        """Return the newest available result of filter_notes_threaded(),
+        or None if there is none yet.
+
+        @returns: object with ivars generation, filtered_notes,
+        match_regexp and active_notes.
+        """
+
+        result = None
+        while True:
+            try:
+                result = self.q_search_res.get_nowait()
+
+            except Empty:
+                return result
+
+    def _helper_search_cancelled(self, generation):
+        return generation is not None and generation != self.search_generation
+
+    def filter_notes_gstyle(self, search_string=None, generation=None):
 
         filtered_notes = []
         # total number of notes, excluding deleted
         active_notes = 0
 
+        # notes can be added and removed by the main thread whilst we are
+        # searching in the background, so we work on a copy of the keys.
+        # we also get a notes_serial that is guaranteed not to be newer
+        # than the notes we look at.
+        notes_serial = self.notes_serial
+
         if not search_string:
-            for k in self.notes:
-                n = self.notes[k]
-                if not n.get('deleted'):
+            for k in self.notes.keys():
+                n = self.notes.get(k)
+                if n is not None and not n.get('deleted'):
                     active_notes += 1
-                    filtered_notes.append(utils.KeyValueObject(key=k, note=n, tagfound=0))
+                    filtered_notes.append(self.helper_result_row(k, n, 0))
 
             return filtered_notes, [], active_notes
 
@@ -317,20 +547,64 @@ class NotesDB(utils.SubjectMixin):
                 if gi[mi]:
                     tms_pats[mi-1].append(gi[mi])
 
-        for k in self.notes:
-            n = self.notes[k]
+        # if the user has only added to the previous search, for example by
+        # typing another character, only the notes that matched that search
+        # can match this one.
+        last = self.last_gstyle_filter
+        if last is not None and last.notes_serial == notes_serial and \
+           last.case_sensitive == self.config.case_sensitive and \
+           self._helper_gstyle_refines(last.tms_pats, tms_pats):
+            keys = last.keys
+            active_notes = last.active_notes
+            count_active = False
+
+        else:
+            keys = self.notes.keys()
+            count_active = True
+
+        # use the index to find the notes that could contain all the words
+        # None means that all notes have to be checked.
+        if self.store.fts:
+            candidates = self.helper_add_unsaved(
+                self.store.gstyle_candidates(tms_pats[0], tms_pats[1] + tms_pats[2]))
+
+        else:
+            candidates = self.word_index.candidates(tms_pats[1] + tms_pats[2])
+
+        if self.config.case_sensitive:
+            msword_pats = tms_pats[1] + tms_pats[2]
+        else:
+            msword_pats = [p.lower() for p in tms_pats[1] + tms_pats[2]]
+
+        for i, k in enumerate(keys):
+            if not i % 256 and self._helper_search_cancelled(generation):
+                raise SearchCancelled()
+
+            n = self.notes.get(k)
+
+            if n is not None and not n.get('deleted'):
+                if count_active:
+                    active_notes += 1
+
+                if candidates is not None and k not in candidates:
+                    continue
+
+                if msword_pats:
+                    c = n.get('content')
 
-            if not n.get('deleted'):
-                active_notes += 1
-                c = n.get('content')
+                else:
+                    # don't bother getting content that we won't look at,
+                    # e.g. with lazily loaded notes.
+                    c = None
 
-                # case insensitive mode: WARNING - SLOW!
                 if not self.config.case_sensitive and c:
-                    c = c.lower()
+                    if self.store.lazy:
+                        # caching would keep all content in memory
+                        c = c.lower()
+                    else:
+                        c = self._helper_lowered_content(k, c)
 
                 tagmatch = self._helper_gstyle_tagmatch(tms_pats[0], n)
-                # case insensitive mode: WARNING - SLOW!
-                msword_pats = tms_pats[1] + tms_pats[2] if self.config.case_sensitive else [p.lower() for p in tms_pats[1] + tms_pats[2]]
                 if tagmatch and self._helper_gstyle_mswordmatch(msword_pats, c):
                     # we have a note that can go through!
 
@@ -338,12 +612,19 @@ class NotesDB(utils.SubjectMixin):
                     # tagmatch == 2 if no tag was specced (so all notes go through)
                     tagfound = 1 if tagmatch == 1 else 0
                     # we have to store our local key also
-                    filtered_notes.append(utils.KeyValueObject(key=k, note=n, tagfound=tagfound))
+                    filtered_notes.append(self.helper_result_row(k, n, tagfound))
+
+        self.last_gstyle_filter = utils.KeyValueObject(
+            notes_serial=notes_serial,
+            case_sensitive=self.config.case_sensitive,
+            tms_pats=tms_pats,
+            keys=[o.key for o in filtered_notes],
+            active_notes=active_notes)
 
         return filtered_notes, '|'.join(tms_pats[1] + tms_pats[2]), active_notes
 
 
-    def filter_notes_regexp(self, search_string=None):
+    def filter_notes_regexp(self, search_string=None, generation=None):
         """Return list of notes filtered with search_string, 
         a regular expression, each a tuple with (local_key, note). 
         """
@@ -360,18 +641,34 @@ class NotesDB(utils.SubjectMixin):
         else:
             sspat = None
 
+        # only notes containing all the literal strings that the regexp
+        # requires can match its content. None means that we have to
+        # check all notes.
+        if sspat and self.store.fts:
+            candidates = self.helper_add_unsaved(
+                self.store.regexp_candidates(regexp_query(sspat)))
+        elif sspat:
+            candidates = self.trigram_index.candidates(regexp_query(sspat))
+        else:
+            candidates = None
+
         filtered_notes = []
         # total number of notes, excluding deleted ones
         active_notes = 0
-        for k in self.notes:
-            n = self.notes[k]
+        # work on a copy of the keys, see filter_notes_gstyle()
+        for i, k in enumerate(self.notes.keys()):
+            if not i % 256 and self._helper_search_cancelled(generation):
+                raise SearchCancelled()
+
+            n = self.notes.get(k)
             # we don't do anything with deleted notes (yet)
-            if n.get('deleted'):
+            if n is None or n.get('deleted'):
                 continue
 
             active_notes += 1
 
-            c = n.get('content')
+            # with lazy_content, only read the content of the candidates
+            content_candidate = candidates is None or k in candidates
             if self.config.search_tags == 1:
                 t = n.get('tags')
                 if sspat:
@@ -385,19 +682,19 @@ class NotesDB(utils.SubjectMixin):
                     # either be first matching element or None (second param)
                     if t and next((ti for ti in t if sspat.search(ti)), None) is not None:
                         # we have to store our local key also
-                        filtered_notes.append(utils.KeyValueObject(key=k, note=n, tagfound=1))
+                        filtered_notes.append(self.helper_result_row(k, n, 1))
 
-                    elif sspat.search(c):
+                    elif content_candidate and sspat.search(n.get('content')):
                         # we have to store our local key also
-                        filtered_notes.append(utils.KeyValueObject(key=k, note=n, tagfound=0))
+                        filtered_notes.append(self.helper_result_row(k, n, 0))
 
                 else:
                     # we have to store our local key also
-                    filtered_notes.append(utils.KeyValueObject(key=k, note=n, tagfound=0))
+                    filtered_notes.append(self.helper_result_row(k, n, 0))
             else:
-                if (not sspat or sspat.search(c)):
+                if not sspat or (content_candidate and sspat.search(n.get('content'))):
                     # we have to store our local key also
-                    filtered_notes.append(utils.KeyValueObject(key=k, note=n, tagfound=0))
+                    filtered_notes.append(self.helper_result_row(k, n, 0))
 
         match_regexp = search_string if sspat else ''
 
@@ -412,15 +709,15 @@ class NotesDB(utils.SubjectMixin):
     def get_note_status(self, key):
         n = self.notes[key]
         o = utils.KeyValueObject(saved=False, synced=False, modified=False)
-        modifydate = float(n['modifydate'])
-        savedate = float(n['savedate'])
+        modifydate = n['modifydate']
+        savedate = n['savedate']
         
         if savedate > modifydate:
             o.saved = True
         else:
             o.modified = True
             
-        if float(n['syncdate']) > modifydate:
+        if n['syncdate'] > modifydate:
             o.synced = True
             
         return o
@@ -428,16 +725,277 @@ class NotesDB(utils.SubjectMixin):
     def get_save_queue_len(self):
         return self.q_save.qsize()
 
+    def helper_all_saved(self):
+        """Return True if all notes in memory are exactly as they are
+        in the store.
+        """
+
+        return not self.keys_to_save and not self.saves_in_flight
+
+    def close(self):
+        """Call when the application exits.
+        """
+
+        if self.helper_all_saved():
+            self.store.write_snapshot(self.notes)
+            self.journal.clear()
+
+        self.journal.close()
+        self.history.close()
+        self.store.close()
+
+        if self.config.simplenote_sync:
+            self.simplenote.close()
+
             
     def get_sync_queue_len(self):
         return self.q_sync.qsize()
         
-    def helper_key_to_fname(self, k):
-            return os.path.join(self.db_path, k) + '.json'
+    def helper_rekey_note(self, old_key, new_key):
+        """Move all bookkeeping of note old_key to new_key.
+
+        Called when a purely local key is replaced by the server's key.
+        """
+
+        self.store.note_rekeyed(old_key, new_key)
+        self.helper_journal_rekey(old_key, new_key)
+        self.history.note_rekeyed(old_key, new_key)
+        self.revisions.pop(old_key, None)
+        self.result_rows.pop(old_key, None)
+        self.word_index.rename(old_key, new_key)
+        self.trigram_index.rename(old_key, new_key)
+        self.lowered_content.pop(old_key, None)
+
+        for dirty in (self.keys_to_save, self.keys_to_sync):
+            if dirty.pop(old_key, None):
+                dirty[new_key] = True
+
+    def helper_mark_dirty(self, k, sync=True):
+        """Record that note k has to be saved, and by default also synced.
+
+        save_threaded() and sync_to_server_threaded() only look at these
+        notes, so this has to be called whenever a note is changed locally,
+        or when a sync changes our copy of the note.
+        """
+
+        self.keys_to_save[k] = True
+        self.unsaved_keys[k] = True
+        self.revisions.pop(k, None)
+        if sync:
+            self.keys_to_sync[k] = True
+
+    def helper_note_revision(self, k):
+        """Return NoteRevision of the current version of note k.
+
+        The revision is reused until the note changes, so the save and the
+        sync of the same version of a note share it.
+        """
+
+        rev = self.revisions.get(k)
+        if rev is None:
+            # iteritems(), so that a LazyNote gives us its content too
+            rev = self.revisions[k] = NoteRevision(self.notes[k].iteritems())
+
+        return rev
+
+    def helper_history_add(self, k, note):
+        """Record the content of note as a version of note k, see
+        NoteHistory. Call this before the content of a note is replaced by
+        a sync, and after a sync saves a note.
+        """
+
+        if not note.get('deleted'):
+            self.history.add(k, note.get('content'), note.get('modifydate'), note.get('savedate'))
+
+    def helper_result_row(self, k, n, tagfound):
+        """Return NoteRow for note n with key k in a search result.
+
+        Every search returns many of the same notes again, so we keep the
+        rows instead of making new ones each time.
+        """
+
+        rows = self.result_rows.get(k)
+        if rows is None or rows[0].note is not n:
+            # the note could have been replaced by a full sync
+            rows = self.result_rows[k] = (NoteRow(k, n, 0), NoteRow(k, n, 1))
+
+        return rows[tagfound]
+
+    def helper_journal(self, k, op, **kwargs):
+        """Append record of a change by the user to note k to the journal.
+
+        The journal is cleared as soon as all notes have been saved, so it
+        only has the changes that could get lost in a crash. These are
+        applied again by helper_replay_journal() at the next start.
+        """
+
+        # a rekeyed note can already be at its new key
+        n = self.notes.get(k)
+        r = {'key' : k, 'op' : op, 'modifydate' : n.get('modifydate') if n is not None else time.time()}
+        r.update(kwargs)
+        self.journal.append(r)
+
+    def helper_journal_content(self, k, content):
+        """Append record of new content of note k to the journal.
+
+        While typing, only a small part of a note changes, so if possible
+        we record the change to the previous content in the journal.
+        """
+
+        base = self.journal_base.get(k)
+        if base is not None and type(base) == type(content):
+            at, remove, insert = text_splice(base, content)
+            self.helper_journal(k, 'splice', at=at, remove=remove, value=insert)
+
+        else:
+            self.helper_journal(k, 'content', value=content)
+
+        self.journal_base[k] = content
+
+    def helper_journal_rekey(self, old_key, new_key):
+        self.helper_journal(old_key, 'rekey', value=new_key)
+        base = self.journal_base.pop(old_key, None)
+        if base is not None:
+            self.journal_base[new_key] = base
+
+    def helper_journal_forget(self, k):
+        """Record that note k has been replaced by a version from the
+        server, so that the changes to k in the journal don't get applied
+        to it.
+
+        If we crash before the new version is saved, the next sync
+        fetches it again.
+        """
+
+        if self.journal.nbytes:
+            self.helper_journal(k, 'forget')
+            self.journal_base.pop(k, None)
+
+    def helper_replay_journal(self, records):
+        """Apply the changes in the journal on top of the notes that were
+        loaded from the store.
+
+        @returns: number of notes that were changed.
+        """
+
+        # records before the last forget of a note don't count, also not
+        # those from before it was rekeyed. a note is known by the key
+        # of the first record about it.
+        first_keys = {}
+        note_ids = []
+        start = {}
+        for i, r in enumerate(records):
+            k = r.get('key')
+            note_id = first_keys.setdefault(k, k)
+            note_ids.append(note_id)
+            if r.get('op') == 'rekey':
+                first_keys[r.get('value')] = note_id
+
+            elif r.get('op') == 'forget':
+                start[note_id] = i
+
+        replayed = {}
+        for i, r in enumerate(records):
+            k = r.get('key')
+            op = r.get('op')
+            if i <= start.get(note_ids[i], -1):
+                continue
+
+            if op == 'create':
+                if k not in self.notes:
+                    self.notes[k] = new_note(r['value'], r['modifydate'])
+                    replayed[k] = True
+
+                continue
+
+            n = self.notes.get(k)
+            if n is None:
+                # e.g. already rekeyed in the store
+                continue
+
+            if op == 'rekey':
+                if r['value'] not in self.notes:
+                    self.notes[r['value']] = self.notes.pop(k)
+                    replayed.pop(k, None)
+                    replayed[r['value']] = True
+
+                continue
+
+            if op == 'content':
+                n['content'] = r['value']
+
+            elif op == 'splice':
+                c = n.get('content', u'')
+                n['content'] = c[:r['at']] + r['value'] + c[r['at'] + r['remove']:]
+
+            elif op in ('tags', 'systemtags'):
+                n[op] = r['value']
+
+            elif op == 'delete':
+                n['deleted'] = 1
+
+            else:
+                logging.warning('NotesDB_init: Unknown journal record %s' % (op,))
+                continue
+
+            n['modifydate'] = r['modifydate']
+            replayed[k] = True
+
+        for k in replayed:
+            # different from what's on disc after all
+            self.notes[k]['savedate'] = 0
+            self.helper_mark_dirty(k)
+
+        return len(replayed)
+
+    def helper_add_unsaved(self, candidates):
+        """Add the notes that the store's full-text index does not know
+        about yet to candidates, if candidates is not None.
+        """
+
+        if candidates is not None:
+            candidates.update(self.unsaved_keys.keys())
+
+        return candidates
+
+    def helper_reindex_note(self, k):
+        """Bring search indices up to date with note k, and invalidate the
+        results of the previous search.
+
+        Has to be called whenever a note's content changes, or when a note
+        is added, deleted or removed.
+        """
+
+        self.lowered_content.pop(k, None)
+        self.revisions.pop(k, None)
+
+        n = self.notes.get(k)
+        if n is None:
+            self.result_rows.pop(k, None)
+
+        if self.store.fts:
+            # we use the store's full-text index instead, which is only up to
+            # date once the note has been saved.
+            self.unsaved_keys[k] = True
+
+        elif n is None or n.get('deleted'):
+            self.word_index.remove(k)
+            self.trigram_index.remove(k)
+
+        else:
+            c = n.get('content')
+            self.word_index.update(k, c)
+            self.trigram_index.update(k, c)
+
+        # only after the indices are up to date, so that a background
+        # search that sees the new serial also sees the new index.
+        self.notes_serial += 1
     
     def helper_save_note(self, k, note):
         """Save a single note to disc.
-        
+
+        note is not changed, so this can be a NoteRevision. The caller
+        records the savedate.
         """
 
         if self.config.notes_as_txt:
@@ -466,7 +1024,11 @@ class NotesDB(utils.SubjectMixin):
                             c = unicode(c)
                         
                         f.write(c)
-                except IOError, e:
+
+                    st = os.stat(fn)
+                    self.txt_written[t] = (st.st_size, st.st_mtime)
+
+                except (IOError, OSError), e:
                     logging.error('NotesDB_save: Error opening %s: %s' % (fn, str(e)))
                     raise WriteError ('Error opening note file')
 
@@ -480,16 +1042,11 @@ class NotesDB(utils.SubjectMixin):
                     logging.debug('Delete file %s ' % (dfn, ))
                     os.unlink(dfn)
         
-        fn = self.helper_key_to_fname(k)
         if not self.config.simplenote_sync and note.get('deleted'):
-            if os.path.isfile(fn):
-                os.unlink(fn)
+            self.store.delete(k)
         else:
-            json.dump(note, open(fn, 'wb'), indent=2)
+            self.store.save(k, note)
 
-        # record that we saved this to disc.
-        note['savedate'] = time.time()
-        
     def sync_note_unthreaded(self, k):
         """Sync a single note with the server.
 
@@ -499,14 +1056,14 @@ class NotesDB(utils.SubjectMixin):
 
         note = self.notes[k]
         
-        if not note.get('key') or float(note.get('modifydate')) > float(note.get('syncdate')):
+        if not note.get('key') or note.get('modifydate') > note.get('syncdate'):
             # if has no key, or it has been modified sync last sync, 
             # update to server
             uret = self.simplenote.update_note(note)
 
             if uret[1] == 0:
                 # success!
-                n = uret[0]
+                n = utils.normalise_note(uret[0])
         
                 # if content was unchanged, there'll be no content sent back!
                 if n.get('content', None):
@@ -521,6 +1078,10 @@ class NotesDB(utils.SubjectMixin):
                 
                 # update our existing note in-place!
                 note.update(n)
+                self.helper_journal_forget(k)
+                self.helper_reindex_note(k)
+                self.helper_mark_dirty(k, sync=False)
+                self.notify_observers('change:note-status', utils.KeyValueObject(what='syncdate', key=k))
         
                 # return the key
                 return (k, new_content)
@@ -534,11 +1095,15 @@ class NotesDB(utils.SubjectMixin):
             gret = self.simplenote.get_note(note['key'])
             
             if gret[1] == 0:
-                n = gret[0]
+                n = utils.normalise_note(gret[0])
                 
-                if int(n.get('syncnum')) > int(note.get('syncnum')):
+                if n.get('syncnum') > note.get('syncnum'):
                     n['syncdate'] = time.time()
                     note.update(n)
+                    self.helper_journal_forget(k)
+                    self.helper_reindex_note(k)
+                    self.helper_mark_dirty(k, sync=False)
+                    self.notify_observers('change:note-status', utils.KeyValueObject(what='syncdate', key=k))
                     return (k, True)
                 
                 else:
@@ -549,14 +1114,20 @@ class NotesDB(utils.SubjectMixin):
 
         
     def save_threaded(self):
-        for k,n in self.notes.items():
-            savedate = float(n.get('savedate'))
-            if float(n.get('modifydate')) > savedate or \
-               float(n.get('syncdate')) > savedate:
-                cn = copy.deepcopy(n)
+        for k in self.keys_to_save.keys():
+            del self.keys_to_save[k]
+            n = self.notes.get(k)
+            if n is None:
+                # removed by a full sync in the meantime
+                continue
+
+            savedate = n.get('savedate')
+            if n.get('modifydate') > savedate or \
+               n.get('syncdate') > savedate:
                 # put it on my queue as a save
-                o = utils.KeyValueObject(action=ACTION_SAVE, key=k, note=cn)
+                o = utils.KeyValueObject(action=ACTION_SAVE, key=k, note=self.helper_note_revision(k))
                 self.q_save.put(o)
+                self.saves_in_flight += 1
                 
         # in this same call, we process stuff that might have been put on the result queue
         nsaved = 0
@@ -569,11 +1140,37 @@ class NotesDB(utils.SubjectMixin):
                 something_in_queue = False
                 
             else:
-                # o (.action, .key, .note) is something that was written to disk
+                # o (.action, .key, .note, .savedate) is something that was written to disk
                 # we only record the savedate.
-                self.notes[o.key]['savedate'] = o.note['savedate']
+                n = self.notes[o.key]
+                n['savedate'] = o.savedate
+                if n.get('content') == o.note.get('content') and \
+                   n.get('tags') == o.note.get('tags'):
+                    # the store is up to date with this note
+                    self.unsaved_keys.pop(o.key, None)
+                    self.store.note_saved(o.key)
+
+                if o.key not in self.keys_to_sync:
+                    # nobody is going to need this revision anymore
+                    self.revisions.pop(o.key, None)
+
                 self.notify_observers('change:note-status', utils.KeyValueObject(what='savedate',key=o.key))
+                self.saves_in_flight -= 1
                 nsaved += 1
+
+        if self.helper_all_saved():
+            # nothing left that could get lost
+            self.journal.clear()
+            self.journal_base = {}
+
+            # once things have been quiet for a while, the store can write its
+            # startup snapshot.
+            if self.store.snapshot_due():
+                self.store.write_snapshot(self.notes)
+
+        else:
+            # once per housekeeping run, instead of for every change
+            self.journal.sync()
                 
         return nsaved
         
@@ -598,25 +1195,39 @@ class NotesDB(utils.SubjectMixin):
         else:
             lastmod = 0
         
+        if self.sync_full_job is not None:
+            # the full sync sends these, if we send a new note as well, it
+            # ends up twice on the server.
+            keys_to_sync = []
+
+        else:
+            keys_to_sync = self.keys_to_sync.keys()
+
         now = time.time()
-        for k,n in self.notes.items():
+        for k in keys_to_sync:
+            n = self.notes.get(k)
             # if note has been modified sinc the sync, we need to sync.
+            # a full sync could have taken care of it in the meantime.
+            if n is None or \
+               n.get('modifydate', -1) <= n.get('syncdate', -1):
+                del self.keys_to_sync[k]
+                continue
+
             # only do so if note hasn't been touched for 3 seconds
             # and if this note isn't still in the queue to be processed by the
-            # worker (this last one very important)
-            modifydate = float(n.get('modifydate', -1))
-            syncdate = float(n.get('syncdate', -1))
-            if modifydate > syncdate and \
-               now - modifydate > lastmod and \
+            # worker (this last one very important). if not, we try again
+            # during the next call.
+            modifydate = n.get('modifydate', -1)
+            if now - modifydate > lastmod and \
                k not in self.threaded_syncing_keys:
+                del self.keys_to_sync[k]
                 # record that we've requested a sync on this note,
                 # so that we don't keep on putting stuff on the queue.
                 self.threaded_syncing_keys[k] = True
-                cn = copy.deepcopy(n)
-                # we store the timestamp when this copy was made as the syncdate
-                cn['syncdate'] = time.time()
+                # we store the timestamp when this revision was taken as the syncdate
                 # put it on my queue as a sync
-                o = utils.KeyValueObject(action=ACTION_SYNC_PARTIAL_TO_SERVER, key=k, note=cn)
+                o = utils.KeyValueObject(action=ACTION_SYNC_PARTIAL_TO_SERVER, key=k,
+                                         note=self.helper_note_revision(k), syncdate=time.time())
                 self.q_sync.put(o)
                 
         # in this same call, we read out the result queue
@@ -635,6 +1246,8 @@ class NotesDB(utils.SubjectMixin):
 
                 if o.error:
                     nerrored += 1
+                    # try again later
+                    self.keys_to_sync[okey] = True
                     
                 else:
                     # o (.action, .key, .note) is something that was synced
@@ -643,14 +1256,21 @@ class NotesDB(utils.SubjectMixin):
                     # what we already have, since the main thread could be
                     # running a full sync whilst the worker thread is putting
                     # results in the queue.
-                    if float(o.note['syncdate']) > float(self.notes[okey]['syncdate']):
+                    if o.note['syncdate'] > self.notes[okey]['syncdate']:
                                         
-                        if float(o.note['syncdate']) > float(self.notes[okey]['modifydate']):
+                        if o.note['syncdate'] > self.notes[okey]['modifydate']:
                             # note was synced AFTER the last modification to our local version
                             # do an in-place update of the existing note
                             # this could be with or without new content.
-                            old_note = copy.deepcopy(self.notes[okey])
+                            old_note = self.helper_note_revision(okey)
+                            if o.note.get('content'):
+                                # the save thread records the new content
+                                self.helper_history_add(okey, old_note)
+
                             self.notes[okey].update(o.note)
+                            self.helper_journal_forget(okey)
+                            self.helper_reindex_note(okey)
+                            self.helper_mark_dirty(okey, sync=False)
                             # notify anyone (probably nvPY) that this note has been changed
                             self.notify_observers('synced:note', utils.KeyValueObject(lkey=okey, old_note=old_note))
                             
@@ -667,6 +1287,9 @@ class NotesDB(utils.SubjectMixin):
                             tkeys = ['syncnum', 'version', 'syncdate', 'key']
                             for tk in tkeys:
                                 self.notes[okey][tk] = o.note[tk]
+
+                            # and the newer local changes still have to go
+                            self.helper_mark_dirty(okey)
                             
                         nsynced += 1
                         self.notify_observers('change:note-status', utils.KeyValueObject(what='syncdate',key=okey))
@@ -678,134 +1301,572 @@ class NotesDB(utils.SubjectMixin):
         return (nsynced, nerrored)
     
     
+    def helper_server_map(self, func, items):
+        """Call func on each of items, with up to config.sync_concurrency
+        calls running at the same time, and yield the results in the order
+        of items.
+
+        func is one of the methods of self.simplenote, which is safe to
+        use from several threads.
+        """
+
+        nthreads = min(self.config.sync_concurrency, len(items))
+        if nthreads <= 1:
+            for item in items:
+                yield func(item)
+
+            return
+
+        pool = ThreadPool(nthreads)
+        try:
+            for ret in pool.imap(func, items):
+                yield ret
+
+        finally:
+            # also when the caller stops early, e.g. with an exception
+            pool.terminate()
+
     def sync_full(self):
         """Perform a full bi-directional sync with server.
-        
+
         This follows the recipe in the SimpleNote 2.0 API documentation.
         After this, it could be that local keys have been changed, so
         reset any views that you might have.
+
+        See sync_full_threaded() for doing this in the background.
+
+        @returns: number of notes that could not be synced.
         """
-        
-        local_updates = {}
-        local_deletes = {}
-        now = time.time()
 
-        self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Starting full sync.'))
+        job = self.helper_sync_full_begin()
+        progress = lambda msg: self.notify_observers('progress:sync_full', utils.KeyValueObject(msg=msg))
+        self.helper_sync_full_try_network(job, progress)
+        return self.helper_sync_full_apply(job)
+
+    def sync_full_threaded(self):
+        """Start a full sync that talks to the server in a background
+        thread, so that the notes can be used in the meantime.
+
+        Call sync_full_poll() regularly until it returns the result.
+
+        @returns: False if a full sync is already running.
+        """
+
+        if self.sync_full_job is not None:
+            return False
+
+        self.sync_full_job = self.helper_sync_full_begin()
+        thread_sync_full = Thread(target=self.worker_sync_full, args=(self.sync_full_job,))
+        thread_sync_full.setDaemon(True)
+        thread_sync_full.start()
+
+        return True
+
+    def sync_full_poll(self):
+        """Pass on the progress of the background full sync, and apply its
+        results to the notes once it's done.
+
+        @returns: None while the sync is still running, else the number of
+        notes that could not be synced, like sync_full().
+        """
+
+        job = self.sync_full_job
+        if job is None:
+            return None
+
+        while True:
+            try:
+                msg = self.q_sync_full.get_nowait()
+
+            except Empty:
+                return None
+
+            if msg is not None:
+                self.notify_observers('progress:sync_full', utils.KeyValueObject(msg=msg))
+                continue
+
+            # the thread is done
+            self.sync_full_job = None
+            return self.helper_sync_full_apply(job)
+
+    def worker_sync_full(self, job):
+        try:
+            self.helper_sync_full_try_network(job, self.q_sync_full.put)
+
+        finally:
+            # tell the main thread that we're done
+            self.q_sync_full.put(None)
+
+    def helper_sync_full_begin(self):
+        """Take everything that sync_full needs to know about the local
+        notes, so that it does not have to look at self.notes while it
+        talks to the server.
+        """
+
+        # the sync thread is already sending these, sending them again
+        # could create the same note twice on the server.
+        busy_keys = dict(self.threaded_syncing_keys)
+
+        # notes that the sync thread has sent to the server for the first
+        # time still have their local key, the server only knows them by
+        # their new key. they are written under that key by
+        # helper_sync_full_apply().
+        rekeyed = [(lk, n['key']) for lk, n in self.notes.items()
+                   if n.get('key') and n['key'] != lk and
+                   n['key'] not in self.notes and lk not in busy_keys]
+        for lk, k in rekeyed:
+            self.notes[k] = self.notes.pop(lk)
+            self.helper_rekey_note(lk, k)
+
         # 1. go through local notes, if anything changed or new, update to server
-        for ni,lk in enumerate(self.notes.keys()):
-            n = self.notes[lk]
-            if not n.get('key') or float(n.get('modifydate')) > float(n.get('syncdate')):
-                uret = self.simplenote.update_note(n)
-                if uret[1] == 0:
-                    # replace n with uret[0]
-                    # if this was a new note, our local key is not valid anymore
-                    del self.notes[lk]
-                    # in either case (new or existing note), save note at assigned key
-                    k = uret[0].get('key')
-                    # we merge the note we got back (content coud be empty!)
-                    n.update(uret[0])
-                    # and put it at the new key slot
-                    self.notes[k] = n
-                    
-                    # record that we just synced
-                    uret[0]['syncdate'] = now
-                    
-                    # whatever the case may be, k is now updated
-                    local_updates[k] = True
-                    if lk != k:
-                        # if lk was a different (purely local) key, should be deleted
-                        local_deletes[lk] = True
-                        
-                    self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Synced modified note %d to server.' % (ni,)))
-                        
-                else:
-                    raise SyncError("Sync step 1 error - Could not update note to server")
-             
+        uploads = [(lk, self.helper_note_revision(lk)) for lk, n in self.notes.items()
+                   if (not n.get('key') or n.get('modifydate') > n.get('syncdate')) and
+                   lk not in busy_keys]
+
+        return utils.KeyValueObject(
+            # this is the syncdate of everything this sync gets
+            now=time.time(),
+            uploads=uploads,
+            local_keys=self.notes.keys(),
+            syncnums=dict((k, n.get('syncnum', -1)) for k, n in self.notes.items()),
+            busy_keys=busy_keys,
+            rekeyed=rekeyed,
+            # what helper_sync_full_apply() gets if the sync fails before
+            # it has the note list: only the notes that were sent.
+            urets=[],
+            partial=True,
+            server_keys={},
+            fetches=[],
+            rets=[],
+            error=None)
+
+    def helper_sync_full_try_network(self, job, progress):
+        """Run helper_sync_full_network(), and put an error in job.error
+        instead of raising it: helper_sync_full_apply() still has to give
+        the notes that were sent before the error their server keys, else
+        the next sync sends them again as new notes.
+        """
+
+        try:
+            self.helper_sync_full_network(job, progress)
+
+        except SyncError, e:
+            job.error = e
+
+        except Exception, e:
+            logging.exception('Error during full sync: %s' % (str(e),))
+            job.error = SyncError('Full sync failed, please check nvpy.log.')
+
+    def helper_sync_full_network(self, job, progress):
+        """Do all of sync_full that needs the server. This can run in any
+        thread: it only uses job, and reports its progress by calling
+        progress with a message.
+
+        Fills in job.urets, job.partial, job.server_keys, job.fetches and
+        job.rets. If it raises, job.urets has the results of the notes that
+        were sent so far.
+        """
+
+        cursor = self.sync_cursor
+        have_cursor = cursor.load()
+
+        progress('Starting full sync.')
+        # like in step 2, the notes are sent concurrently, but the results
+        # are applied in order.
+        urets = self.helper_server_map(self.simplenote.update_note,
+                                       [rev for lk, rev in job.uploads])
+        # notes that we could not update on the server. these keep their
+        # local changes, and are tried again at the next sync.
+        failed_keys = {}
+        for ni, ((lk, rev), uret) in enumerate(izip(job.uploads, urets)):
+            job.urets.append(uret)
+            if uret[1] == 0:
+                k = uret[0].get('key')
+                utils.normalise_note(uret[0])
+                # what we have now, as far as step 2 is concerned
+                job.syncnums[k] = uret[0].get('syncnum')
+                progress('Synced modified note %d to server.' % (ni,))
+
+            else:
+                logging.error('Error syncing modified note %s to server: %s' % (lk, uret[0]))
+                failed_keys[lk] = True
+
         # 2. if remote syncnum > local syncnum, update our note; if key is new, add note to local.
-        # this gets the FULL note list, even if multiple gets are required
-        self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Retrieving full note list from server, could take a while.'))       
-        nl = self.simplenote.get_note_list()
-        if nl[1] == 0:
-            nl = nl[0]
-            self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Retrieved full note list from server.'))
-            
-        else:
-            raise SyncError('Could not get note list from server.')
-        
+        # if the previous sync was recent enough, we only ask for the notes
+        # that changed since then.
+        partial = False
+        if have_cursor and job.now - cursor.listdate < FULL_NOTE_LIST_INTERVAL_S:
+            progress('Retrieving changed notes from server.')
+            nl = self.simplenote.get_note_list(since=cursor.since)
+            if nl[1] == 0:
+                nl = nl[0]
+                partial = True
+                progress('Retrieved %d changed notes from server.' % (len(nl),))
+
+            else:
+                logging.warning('Could not get changed notes from server, getting full note list instead: %s' % (nl[0],))
+
+        if not partial:
+            # this gets the FULL note list, even if multiple gets are required
+            progress('Retrieving full note list from server, could take a while.')
+            nl = self.simplenote.get_note_list()
+            if nl[1] == 0:
+                nl = nl[0]
+                progress('Retrieved full note list from server.')
+
+            else:
+                raise SyncError('Could not get note list from server.')
+
+            cursor.since = None
+            cursor.listdate = job.now
+
         server_keys = {}
-        lennl = len(nl)
-        sync_from_server_errors = 0
+        # (index in nl, key) of the notes we have to get from the server
+        fetches = []
         for ni,n in enumerate(nl):
+            utils.normalise_note(n)
             k = n.get('key')
             server_keys[k] = True
+            if n.get('modifydate') > cursor.since:
+                cursor.since = n.get('modifydate')
+
+            if k in failed_keys or k in job.busy_keys:
+                # don't overwrite the local changes that are still waiting
+                # to go to the server
+                continue
+
             # this works, only because in phase 1 we rewrite local keys to
             # server keys when we get an updated not back from the server
-            if k in self.notes:
-                # we already have this
-                # check if server n has a newer syncnum than mine
-                if int(n.get('syncnum')) > int(self.notes[k].get('syncnum', -1)):
-                    # and the server is newer
-                    ret = self.simplenote.get_note(k)
-                    if ret[1] == 0:
-                        self.notes[k].update(ret[0])
-                        local_updates[k] = True
-                        # in both cases, new or newer note, syncdate is now.
-                        self.notes[k]['syncdate'] = now
-                        self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Synced newer note %d (%d) from server.' % (ni,lennl)))
+            if n.get('syncnum') > job.syncnums.get(k, -1):
+                # the server is newer, or we don't have it at all
+                fetches.append((ni, k))
+
+        # the notes are fetched concurrently, but the results are applied
+        # in the order of the note list.
+        rets = self.helper_server_map(self.simplenote.get_note, [k for ni, k in fetches])
+        job.rets = []
+        for (ni, k), ret in izip(fetches, rets):
+            job.rets.append(ret)
+            if ret[1] == 0:
+                utils.normalise_note(ret[0])
+                progress('Synced %s note %d (%d) from server.' % ('newer' if k in job.syncnums else 'new', ni, len(nl)))
+
+        job.partial = partial
+        job.server_keys = server_keys
+        job.fetches = fetches
+
+    def helper_sync_full_apply(self, job):
+        """Apply what helper_sync_full_network() got from the server to
+        the notes. Has to run in the main thread.
+
+        The user could have changed notes while we were talking to the
+        server. As in sync_to_server_threaded(), these changes win, and are
+        sent at the next sync.
+
+        If the sync failed, this applies what we have, and then raises
+        job.error.
+
+        @returns: number of notes that could not be synced.
+        """
 
-                    else:
-                        logging.error('Error syncing newer note %s from server: %s' % (k, ret[0]))
-                        sync_from_server_errors+=1
+        local_updates = dict((k, True) for lk, k in job.rekeyed)
+        local_deletes = dict((lk, True) for lk, k in job.rekeyed)
+        failed_keys = {}
+        now = job.now
+
+        for (lk, rev), uret in izip(job.uploads, job.urets):
+            n = self.notes.get(lk)
+            if uret[1] != 0:
+                failed_keys[lk] = True
+                continue
+
+            if n is None:
+                # e.g. removed by the text file watcher in the meantime
+                continue
+
+            # if this was a new note, our local key is not valid anymore
+            k = uret[0].get('key')
+            del self.notes[lk]
+
+            if now > n.get('modifydate'):
+                if uret[0].get('content'):
+                    # the server merged in changes from elsewhere
+                    self.helper_history_add(lk, n)
+
+                # we merge the note we got back (content coud be empty!)
+                n.update(uret[0])
+                # whatever the case may be, k is now updated
+                local_updates[k] = True
+
+            else:
+                # the user has changed the note since we sent it, only
+                # record which version of the note the server has.
+                # VERY importantly: also store the key, else we'll keep
+                # on sending new notes.
+                for tk in ('syncnum', 'version', 'key'):
+                    n[tk] = uret[0][tk]
+
+            # record that we just synced
+            n['syncdate'] = now
+            # and put it at the new key slot
+            self.notes[k] = n
+            if lk != k:
+                self.helper_rekey_note(lk, k)
+                # if lk was a different (purely local) key, should be deleted
+                local_deletes[lk] = True
+
+            if k in local_updates:
+                self.helper_journal_forget(k)
+                self.helper_reindex_note(k)
 
             else:
+                # the newer local changes still have to go
+                self.helper_mark_dirty(k)
+
+        sync_from_server_errors = 0
+        for (ni, k), ret in izip(job.fetches, job.rets):
+            if ret[1] != 0:
+                logging.error('Error syncing %s note %s from server: %s' % ('newer' if k in job.syncnums else 'new', k, ret[0]))
+                sync_from_server_errors+=1
+                continue
+
+            n = self.notes.get(k)
+            if n is None:
                 # new note
-                ret = self.simplenote.get_note(k)
-                if ret[1] == 0:
-                    self.notes[k] = ret[0]
-                    local_updates[k] = True
-                    # in both cases, new or newer note, syncdate is now.
-                    self.notes[k]['syncdate'] = now
-                    self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Synced new note %d (%d) from server.' % (ni,lennl)))
+                self.notes[k] = ret[0]
 
-                else:
-                    logging.error('Error syncing new note %s from server: %s' % (k, ret[0]))
-                    sync_from_server_errors+=1
+            elif n.get('modifydate') > n.get('syncdate'):
+                # changed by the user while we were busy, keep the changes,
+                # but remember which version they are based on.
+                for tk in ('syncnum', 'version'):
+                    n[tk] = ret[0][tk]
+
+                self.helper_mark_dirty(k)
+                continue
+
+            else:
+                old_note = self.helper_note_revision(k)
+                self.helper_history_add(k, old_note)
+                n.update(ret[0])
+                self.notify_observers('synced:note', utils.KeyValueObject(lkey=k, old_note=old_note))
+
+            self.helper_journal_forget(k)
+            self.helper_reindex_note(k)
+            local_updates[k] = True
+            # in both cases, new or newer note, syncdate is now.
+            self.notes[k]['syncdate'] = now
+
+        # 3. for each local note not in server index, remove.
+        # a list of only the changed notes doesn't tell us which notes are
+        # gone. notes that were created during the sync are not in it
+        # either.
+        if not job.partial:
+            for lk in job.local_keys:
+                n = self.notes.get(lk)
+                # a new note that we could not send yet is not on the server
+                if n is None or lk in job.server_keys or lk in failed_keys or \
+                   lk in job.busy_keys or n.get('modifydate') > now:
+                    continue
 
-        # 3. for each local note not in server index, remove.     
-        for lk in self.notes.keys():
-            if lk not in server_keys:
                 if self.config.notes_as_txt:
-                    tfn = os.path.join(self.config.txt_path, utils.get_note_title_file(self.notes[lk]))
+                    tfn = os.path.join(self.config.txt_path, utils.get_note_title_file(n))
                     if os.path.isfile(tfn):
                         os.unlink(tfn)
                 del self.notes[lk]
+                self.helper_reindex_note(lk)
+                local_updates.pop(lk, None)
                 local_deletes[lk] = True
-                
+
         # sync done, now write changes to db_path
-        for uk in local_updates.keys():
-            try:
-                self.helper_save_note(uk, self.notes[uk])
+        with self.store.transaction():
+            for uk in local_updates.keys():
+                try:
+                    self.helper_save_note(uk, self.notes[uk])
 
-            except WriteError, e:
-                raise WriteError(e)
-            
-        for dk in local_deletes.keys():
-            fn = self.helper_key_to_fname(dk)
-            if os.path.exists(fn):
-                os.unlink(fn)
+                except WriteError, e:
+                    raise WriteError(e)
+
+                # record that we saved this to disc.
+                self.notes[uk]['savedate'] = time.time()
+                self.unsaved_keys.pop(uk, None)
+                self.store.note_saved(uk)
+                self.helper_history_add(uk, self.notes[uk])
+
+            for dk in local_deletes.keys():
+                self.store.delete(dk)
+
+        if job.error is not None:
+            raise job.error
+
+        # notes we could not get have to be in the next list of changes too
+        if not sync_from_server_errors:
+            self.sync_cursor.save()
 
         self.notify_observers('progress:sync_full', utils.KeyValueObject(msg='Full sync complete.'))
 
-        return sync_from_server_errors
-        
+        return len(failed_keys) + sync_from_server_errors
+
+    def process_txt_changes(self):
+        """Apply the changes that other programs made to the text files
+        of the notes since the previous call. Call this regularly from the
+        main thread.
+
+        A changed note is reported with a synced:note event, just like a
+        newer version from the server. Changes to a note that has unsaved
+        changes in nvPY are ignored, our version overwrites the file when
+        it's saved.
+
+        @returns: number of notes that were created, changed or deleted.
+        """
+
+        if self.txt_watcher is None:
+            return 0
+
+        events = self.txt_watcher.get_events()
+        if not events:
+            return 0
+
+        # we only use the events to find out which files to look at, what
+        # counts is how the files are now.
+        names = {}
+        renames = []
+        for e in events:
+            if e[0] == 'rescan':
+                names.update(dict.fromkeys(self.titlelist.values()))
+                try:
+                    # unicode names, like those of the watcher
+                    names.update(dict.fromkeys(n for n in os.listdir(self.txt_watcher.path)
+                                               if txt_watcher.is_txt_name(n)))
+
+                except OSError, ex:
+                    logging.error('NotesDB: Error listing %s: %s' % (self.config.txt_path, str(ex)))
+
+            elif e[0] == 'renamed':
+                renames.append(e[1:])
+                names[e[1]] = True
+                names[e[2]] = True
+
+            else:
+                names[e[1]] = True
+
+        name_to_key = dict((fn, k) for k, fn in self.titlelist.items() if k in self.notes)
+
+        # a renamed file stays the same note
+        for old_name, new_name in renames:
+            k = name_to_key.get(old_name)
+            if k is not None and new_name not in name_to_key and \
+               not os.path.exists(os.path.join(self.config.txt_path, old_name)):
+                logging.debug('Text note was renamed: %s -> %s' % (old_name, new_name))
+                self.titlelist[k] = new_name
+                del name_to_key[old_name]
+                name_to_key[new_name] = k
+
+        nchanged = 0
+        for name in names:
+            k = name_to_key.get(name)
+            if k is not None and (k in self.unsaved_keys or self.notes[k].get('deleted')):
+                # we are writing or deleting this file ourselves
+                continue
+
+            tfn = os.path.join(self.config.txt_path, name)
+            try:
+                tst = os.stat(tfn)
+
+            except OSError:
+                tst = None
+
+            if tst is None or not stat.S_ISREG(tst.st_mode):
+                if k is not None:
+                    logging.debug('Text note was deleted: %s' % (k,))
+                    del self.titlelist[k]
+                    self.delete_note(k)
+                    nchanged += 1
+
+                continue
+
+            if self.txt_written.get(name) == (tst.st_size, tst.st_mtime):
+                continue
+
+            try:
+                with codecs.open(tfn, mode='rb', encoding='utf-8') as f:
+                    c = f.read()
+
+            except (IOError, ValueError), e:
+                # e.g. the other program is still busy with it, we'll get
+                # another event when it's done.
+                logging.error('NotesDB: Error reading %s: %s' % (tfn, str(e)))
+                continue
+
+            if k is None:
+                logging.debug('New text note found : %s' % (name,))
+                nk = self.create_note(c)
+                if name == utils.get_note_title_file(self.notes[nk]):
+                    self.titlelist[nk] = name
+
+                else:
+                    # same as during startup: the note is written to the
+                    # file that goes with its title.
+                    nn = os.path.splitext(name)[0]
+                    if nn != utils.get_note_title(self.notes[nk]):
+                        self.set_note_content(nk, nn + "\n\n" + c)
+
+                    try:
+                        os.unlink(tfn)
+
+                    except OSError, e:
+                        logging.error('NotesDB: Error removing %s: %s' % (tfn, str(e)))
+
+                nchanged += 1
+
+            elif c != self.notes[k].get('content'):
+                logging.debug('Text note was changed: %s' % (k,))
+                old_note = self.helper_note_revision(k)
+                self.set_note_content(k, c)
+                self.notify_observers('synced:note', utils.KeyValueObject(lkey=k, old_note=old_note))
+                nchanged += 1
+
+        return nchanged
+
     def set_note_content(self, key, content):
         n = self.notes[key]
         old_content = n.get('content')
         if content != old_content:
             n['content'] = content
             n['modifydate'] = time.time()
+            self.helper_reindex_note(key)
+            self.helper_mark_dirty(key)
+            self.helper_journal_content(key, content)
             self.notify_observers('change:note-status', utils.KeyValueObject(what='modifydate', key=key))
 
+    def get_note_revisions(self, key):
+        """Return list of the earlier versions of note key that can be
+        restored, newest first, as KeyValueObject(seq, savedate,
+        modifydate).
+        """
+
+        return self.history.list(key)
+
+    def get_note_revision_content(self, key, seq):
+        """Return content of version seq of note key, or None if we
+        don't have it anymore.
+        """
+
+        return self.history.get_content(key, seq)
+
+    def restore_note_revision(self, key, seq):
+        """Make version seq the content of note key. This is an edit like
+        any other, so it's saved and synced as usual.
+
+        @returns: True if the version was restored.
+        """
+
+        content = self.history.get_content(key, seq)
+        if content is None:
+            return False
+
+        self.set_note_content(key, content)
+        return True
+
     def set_note_tags(self, key, tags):
         n = self.notes[key]
         old_tags = n.get('tags')
@@ -813,50 +1874,99 @@ class NotesDB(utils.SubjectMixin):
         if tags != old_tags:
             n['tags'] = tags
             n['modifydate'] = time.time()
+            self.helper_mark_dirty(key)
+            self.helper_journal(key, 'tags', value=tags)
+            self.notes_serial += 1
             self.notify_observers('change:note-status', utils.KeyValueObject(what='modifydate', key=key))
 
     def set_note_pinned(self, key, pinned):
         n = self.notes[key]
         old_pinned = utils.note_pinned(n)
         if pinned != old_pinned:
-            if 'systemtags' not in n:
-                n['systemtags'] = []
-
-            systemtags = n['systemtags']
+            # a new list, the old one could be part of a NoteRevision
+            systemtags = [t for t in n.get('systemtags', []) if t != 'pinned']
 
             if pinned:
                 # which by definition means that it was NOT pinned
                 systemtags.append('pinned')
 
-            else:
-                systemtags.remove('pinned')
+            n['systemtags'] = systemtags
 
             n['modifydate'] = time.time()
+            self.helper_mark_dirty(key)
+            self.helper_journal(key, 'systemtags', value=systemtags)
+            self.notes_serial += 1
             self.notify_observers('change:note-status', utils.KeyValueObject(what='modifydate', key=key))
 
 
     def worker_save(self):
         while True:
-            o = self.q_save.get()
-
-            if o.action == ACTION_SAVE:
-                # this will write the savedate into o.note
-                # with filename o.key.json
+            # take everything that's waiting, so that the store can write
+            # it in one go.
+            batch = [self.q_save.get()]
+            while True:
                 try:
-                    self.helper_save_note(o.key, o.note)
+                    batch.append(self.q_save.get_nowait())
 
-                except WriteError, e:
-                    logging.error('FATAL ERROR in access to file system')
-                    print "FATAL ERROR: Check the nvpy.log"
-                    os._exit(1) 
+                except Empty:
+                    break
+
+            batch = [o for o in batch if o.action == ACTION_SAVE]
+
+            try:
+                with self.store.transaction():
+                    for o in batch:
+                        self.helper_save_note(o.key, o.note)
+                        o.savedate = time.time()
+
+            except WriteError, e:
+                logging.error('FATAL ERROR in access to file system')
+                print "FATAL ERROR: Check the nvpy.log"
+                os._exit(1) 
+
+            else:
+                for o in batch:
+                    if not o.note.get('deleted'):
+                        self.history.add(o.key, o.note.get('content'), o.note.get('modifydate'), o.savedate)
 
-                else:
                     # put the whole thing back into the result q
-                    # now we don't have to copy, because this thread
-                    # is never going to use o again.
+                    # this thread is never going to use o again.
                     # somebody has to read out the queue...
                     self.q_save_res.put(o)
                 
+    def worker_search(self):
+        while True:
+            o = self.q_search.get()
+
+            # skip straight to the newest request in the queue
+            something_in_queue = True
+            while something_in_queue:
+                try:
+                    o = self.q_search.get_nowait()
+
+                except Empty:
+                    something_in_queue = False
+
+            if self._helper_search_cancelled(o.generation):
+                continue
+
+            try:
+                filtered_notes, match_regexp, active_notes = \
+                    self.filter_notes(o.search_string, o.generation)
+
+            except SearchCancelled:
+                continue
+
+            except Exception, e:
+                # this thread must never die, else searching stops.
+                logging.exception('Error searching for %s: %s' % (o.search_string, str(e)))
+                continue
+
+            o.filtered_notes = filtered_notes
+            o.match_regexp = match_regexp
+            o.active_notes = active_notes
+            self.q_search_res.put(o)
+
     def worker_sync(self):
         while True:
             o = self.q_sync.get()
@@ -874,22 +1984,19 @@ class NotesDB(utils.SubjectMixin):
                 
                 if uret[1] == 0:
                     # success!
-                    n = uret[0]
+                    n = utils.normalise_note(uret[0])
 
-                    if not n.get('content', None):
-                        # if note has not been changed, we don't get content back
-                        # delete our own copy too.
-                        del o.note['content']
-                        
+                    # if note has not been changed, we don't get content back,
+                    # so n only has what has to be updated in our note.
                     logging.debug('Server replies with updated note ' + n['key'])
                         
-                    # syncdate was set when the note was copied into our queue
+                    # syncdate was set when the revision was put into our queue
                     # we rely on that to determine when a returned note should
                     # overwrite a note in the main list.
+                    n['syncdate'] = o.syncdate
                         
                     # store the actual note back into o
-                    # in-place update of our existing note copy
-                    o.note.update(n)
+                    o.note = n
 
                     # success!
                     o.error = 0
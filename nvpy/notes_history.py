@@ -0,0 +1,374 @@
+# nvPY: cross-platform note-taking app with simplenote syncing
+# copyright 2012 by Charl P. Botha <cpbotha@vxlabs.com>
+# new BSD license
+
+"""Earlier versions of notes, so that content that was overwritten by a sync
+or by mistake can be restored.
+"""
+
+import base64
+from collections import OrderedDict
+import difflib
+import json
+import logging
+from notes_store import replace_file, fsync_dir
+import os
+from threading import Lock
+import utils
+import zlib
+
+def line_delta(old, new):
+    """Return list of operations that turns text old into text new.
+
+    An operation is either a [start, end] pair, meaning lines start up to
+    end of old, or a string that has to be inserted.
+    """
+
+    a = old.splitlines(True)
+    b = new.splitlines(True)
+
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b).get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+
+        elif tag != 'delete':
+            ops.append(u''.join(b[j1:j2]))
+
+    return ops
+
+def apply_line_delta(old, ops):
+    a = old.splitlines(True)
+    out = []
+    for op in ops:
+        if isinstance(op, list):
+            out.extend(a[op[0]:op[1]])
+
+        else:
+            out.append(op)
+
+    return u''.join(out)
+
+def pack(o):
+    return base64.b64encode(zlib.compress(json.dumps(o)))
+
+def unpack(s):
+    return json.loads(zlib.decompress(base64.b64decode(s)))
+
+class NoteHistory:
+    """Append-only file with the saved versions of all notes.
+
+    Every version of the content of a note is stored as a compressed line
+    delta against the version before it. Every KEYFRAME_INTERVAL versions,
+    or when the delta would not be smaller, we store the complete content,
+    so that we never have to apply many deltas to get at a version.
+
+    We keep the max_revisions latest versions of each note. Older versions
+    stay in the file until most of it is garbage, then the file is
+    rewritten with only the versions we keep, see _compact_if_needed().
+
+    The file is only read the first time it's used, which is usually the
+    first save after startup, in the save thread.
+
+    @ivar index: dict mapping key to list of [seq, savedate, modifydate,
+    offset, length, full] of each version, oldest first.
+    @ivar last: OrderedDict mapping key to the content of its latest
+    version, for the LAST_SIZE notes that were saved most recently.
+    @ivar live_bytes: number of bytes in the file taken by versions that we
+    keep.
+    """
+
+    FNAME = 'notes.history'
+
+    # store the whole content after this many deltas
+    KEYFRAME_INTERVAL = 10
+
+    # number of notes whose latest content we keep in memory
+    LAST_SIZE = 16
+
+    # don't bother compacting files smaller than this
+    COMPACT_MIN_BYTES = 1024 * 1024
+
+    def __init__(self, db_path, max_revisions):
+        self.db_path = db_path
+        self.fname = os.path.join(db_path, self.FNAME)
+        self.max_revisions = max_revisions
+        self.f = None
+        self.index = None
+        self.last = OrderedDict()
+        self.live_bytes = 0
+        self.log_bytes = 0
+        self.failed = False
+        # versions are added by the save thread, and read by the main thread
+        self.lock = Lock()
+
+    def _load(self):
+        """Open the file and build the index, if we haven't done so yet.
+        Caller has to hold the lock.
+        """
+
+        if self.index is not None:
+            return
+
+        self.index = {}
+        try:
+            self.f = open(self.fname, 'a+b')
+            self.f.seek(0)
+
+            offset = 0
+            for line in self.f:
+                try:
+                    if not line.endswith('\n'):
+                        raise ValueError('incomplete line')
+
+                    self._index_record(json.loads(line), offset, len(line))
+
+                except (ValueError, KeyError), e:
+                    logging.warning('NoteHistory: Ignoring end of %s: %s' % (self.fname, str(e)))
+                    self.f.truncate(offset)
+                    break
+
+                offset += len(line)
+
+        except IOError, e:
+            logging.error('NoteHistory: Error opening %s, history disabled: %s' % (self.fname, str(e)))
+            self.failed = True
+            return
+
+        self.log_bytes = offset
+        self.live_bytes = sum(self._live_bytes(v) for v in self.index.values())
+
+    def _live_bytes(self, versions):
+        return sum(v[4] for v in versions[-self.max_revisions:])
+
+    def _index_record(self, r, offset, length):
+        k = r['key']
+        if 'rekey' in r:
+            versions = self.index.pop(k, None)
+            if versions is not None:
+                self.index[r['rekey']] = versions
+
+            return
+
+        versions = self.index.setdefault(k, [])
+        versions.append([r['seq'], r['savedate'], r['modifydate'], offset, length, 'full' in r])
+
+    def _append(self, r):
+        line = json.dumps(r) + '\n'
+        self.f.seek(0, os.SEEK_END)
+        self.f.write(line)
+        self.f.flush()
+
+        offset = self.log_bytes
+        self.log_bytes += len(line)
+        return offset, len(line)
+
+    def _read_record(self, v):
+        self.f.seek(v[3])
+        return json.loads(self.f.read(v[4]))
+
+    def _content(self, versions, i):
+        """Return content of versions[i].
+        """
+
+        start = i
+        while not versions[start][5]:
+            start -= 1
+
+        c = None
+        for v in versions[start:i + 1]:
+            r = self._read_record(v)
+            c = unpack(r['full']) if v[5] else apply_line_delta(c, unpack(r['delta']))
+
+        return c
+
+    def add(self, k, content, modifydate, savedate):
+        """Record content as the latest version of note k, if it has
+        changed since the previous one.
+        """
+
+        if not self.max_revisions:
+            return
+
+        content = content or u''
+        if isinstance(content, str):
+            content = unicode(content, 'utf-8', 'replace')
+
+        with self.lock:
+            self._load()
+            if self.failed:
+                return
+
+            try:
+                versions = self.index.get(k)
+                if versions:
+                    prev = self.last.pop(k, None)
+                    if prev is None:
+                        prev = self._content(versions, len(versions) - 1)
+
+                    if prev == content:
+                        self._set_last(k, prev)
+                        return
+
+                    seq = versions[-1][0] + 1
+                    since_keyframe = 0
+                    for v in reversed(versions):
+                        if v[5]:
+                            break
+                        since_keyframe += 1
+
+                else:
+                    prev = None
+                    seq = 1
+
+                r = {'key' : k, 'seq' : seq,
+                     'savedate' : savedate, 'modifydate' : modifydate}
+
+                full = pack(content)
+                delta = None
+                if prev is not None and since_keyframe + 1 < self.KEYFRAME_INTERVAL:
+                    delta = pack(line_delta(prev, content))
+
+                if delta is not None and len(delta) < len(full):
+                    r['delta'] = delta
+
+                else:
+                    r['full'] = full
+
+                offset, length = self._append(r)
+
+            except (IOError, OSError, ValueError, zlib.error), e:
+                logging.error('NoteHistory: Error writing %s, history disabled: %s' % (self.fname, str(e)))
+                self.failed = True
+                return
+
+            versions = self.index.setdefault(k, [])
+            old_live = self._live_bytes(versions)
+            versions.append([seq, r['savedate'], r['modifydate'], offset, length, 'full' in r])
+            self.live_bytes += self._live_bytes(versions) - old_live
+            self._set_last(k, content)
+
+            self._compact_if_needed()
+
+    def _set_last(self, k, content):
+        """Remember content as the latest version of note k, and forget
+        the least recently saved note if we have too many. Caller has to
+        hold the lock.
+        """
+
+        self.last.pop(k, None)
+        self.last[k] = content
+        if len(self.last) > self.LAST_SIZE:
+            self.last.popitem(last=False)
+
+    def note_rekeyed(self, old_key, new_key):
+        with self.lock:
+            self._load()
+            if self.failed or old_key not in self.index:
+                return
+
+            try:
+                self._append({'key' : old_key, 'rekey' : new_key})
+
+            except (IOError, OSError), e:
+                logging.error('NoteHistory: Error writing %s, history disabled: %s' % (self.fname, str(e)))
+                self.failed = True
+                return
+
+            self.index[new_key] = self.index.pop(old_key)
+            if old_key in self.last:
+                self._set_last(new_key, self.last.pop(old_key))
+
+    def list(self, k):
+        """Return list of the versions of note k that we keep, newest
+        first, as KeyValueObject(seq, savedate, modifydate).
+        """
+
+        with self.lock:
+            self._load()
+            if self.failed:
+                return []
+
+            versions = self.index.get(k, [])[-self.max_revisions:]
+            return [utils.KeyValueObject(seq=v[0], savedate=v[1], modifydate=v[2])
+                    for v in reversed(versions)]
+
+    def get_content(self, k, seq):
+        """Return content of version seq of note k, or None if we don't
+        have that version.
+        """
+
+        with self.lock:
+            self._load()
+            if self.failed:
+                return None
+
+            versions = self.index.get(k, [])
+            first = max(0, len(versions) - self.max_revisions)
+            for i in xrange(first, len(versions)):
+                if versions[i][0] == seq:
+                    try:
+                        return self._content(versions, i)
+
+                    except (IOError, ValueError, KeyError, zlib.error), e:
+                        logging.error('NoteHistory: Error reading %s: %s' % (self.fname, str(e)))
+                        return None
+
+            return None
+
+    def _compact_if_needed(self):
+        """Rewrite the file with only the versions we keep once more than
+        half of it is garbage. Caller has to hold the lock.
+        """
+
+        if self.log_bytes < self.COMPACT_MIN_BYTES or \
+           self.log_bytes < 2 * self.live_bytes:
+            return
+
+        logging.debug('Compacting %s: %d of %d bytes in use' % (self.fname, self.live_bytes, self.log_bytes))
+
+        tmp_fname = self.fname + '.tmp'
+        new_index = {}
+        offset = 0
+        try:
+            with open(tmp_fname, 'wb') as tf:
+                for k, versions in self.index.items():
+                    first = max(0, len(versions) - self.max_revisions)
+                    new_versions = new_index[k] = []
+                    for i in xrange(first, len(versions)):
+                        v = versions[i]
+                        r = self._read_record(v)
+                        r['key'] = k
+                        if i == first and not v[5]:
+                            # the versions it is a delta of are going
+                            r['full'] = pack(self._content(versions, i))
+                            del r['delta']
+
+                        line = json.dumps(r) + '\n'
+                        tf.write(line)
+                        new_versions.append([v[0], v[1], v[2], offset, len(line), 'full' in r])
+                        offset += len(line)
+
+                tf.flush()
+                os.fsync(tf.fileno())
+
+            self.f.close()
+            replace_file(tmp_fname, self.fname)
+            fsync_dir(self.db_path)
+
+        except (IOError, OSError, ValueError, zlib.error), e:
+            logging.error('NoteHistory: Error compacting %s, history disabled: %s' % (self.fname, str(e)))
+            self.failed = True
+            return
+
+        self.f = open(self.fname, 'a+b')
+        self.index = new_index
+        self.live_bytes = self.log_bytes = offset
+
+    def close(self):
+        with self.lock:
+            # the save thread could still be running
+            self.failed = True
+            if self.f is not None:
+                self.f.close()
+                self.f = None
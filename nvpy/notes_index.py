@@ -0,0 +1,278 @@
+# nvPY: cross-platform note-taking app with simplenote syncing
+# copyright 2012 by Charl P. Botha <cpbotha@vxlabs.com>
+# new BSD license
+
+"""In-memory search indices that NotesDB keeps next to its notes dict.
+
+The indices never decide on their own whether a note matches: they only
+return a (small) set of candidate keys that is guaranteed to contain every
+note that can match. The caller then does the real test on those
+candidates.
+"""
+
+import re
+import sre_constants
+import sre_parse
+
+# we index runs of alphanumeric characters
+word_re = re.compile(r'\w+', re.UNICODE)
+
+def normalise_text(text):
+    """Return lowercased unicode version of text, for indexing purposes.
+    """
+
+    if not text:
+        return u''
+
+    if isinstance(text, str):
+        text = unicode(text, 'utf-8', 'replace')
+
+    return text.lower()
+
+class TermIndex:
+    """Inverted index from term to the set of keys of the notes containing
+    that term. Subclasses decide what the terms of a note are.
+
+    @ivar postings: dict mapping term to set of note keys.
+    @ivar note_terms: dict mapping note key to frozenset of its terms.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.note_terms = {}
+
+    def terms(self, content):
+        """Return frozenset of terms that should be indexed for content.
+        """
+        raise NotImplementedError
+
+    def update(self, key, content):
+        """(Re-)index note key with the given content.
+
+        Only the difference with the previously indexed terms is applied, so
+        this is cheap when a note is being edited.
+        """
+
+        new_terms = self.terms(content)
+        old_terms = self.note_terms.get(key, frozenset())
+
+        if new_terms == old_terms:
+            return
+
+        for t in old_terms - new_terms:
+            keys = self.postings.get(t)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.postings[t]
+
+        for t in new_terms - old_terms:
+            keys = self.postings.get(t)
+            if keys is None:
+                self.postings[t] = set([key])
+            else:
+                keys.add(key)
+
+        self.note_terms[key] = new_terms
+
+    def remove(self, key):
+        self.update(key, None)
+        self.note_terms.pop(key, None)
+
+    def rename(self, old_key, new_key):
+        """Move the entries of old_key over to new_key, e.g. when a
+        note gets its server key during a sync.
+        """
+
+        terms = self.note_terms.pop(old_key, None)
+        if terms is None:
+            return
+
+        for t in terms:
+            keys = self.postings[t]
+            keys.discard(old_key)
+            keys.add(new_key)
+
+        self.note_terms[new_key] = terms
+
+    def keys_for_term(self, term):
+        keys = self.postings.get(term)
+        # return a copy, callers are going to modify it.
+        return set(keys) if keys else set()
+
+class WordIndex(TermIndex):
+    """Index of the lowercased words in each note.
+
+    gstyle search does substring matching, so a pattern can match only part
+    of a word. Every word in the pattern has to be a substring of at least
+    one word in a matching note however, so we look up all indexed words
+    containing each pattern word and intersect the results.
+    """
+
+    def terms(self, content):
+        return frozenset(word_re.findall(normalise_text(content)))
+
+    def _keys_for_word(self, word):
+        """Return set of keys of notes having a word that contains word.
+        """
+
+        # an exact hit is the common case, but we still have to look for
+        # words that contain this one, e.g. "note" in "notes".
+        found = self.keys_for_term(word)
+
+        # postings.keys() gives us a copy, so this is safe even if the main
+        # thread modifies the index in the meantime.
+        for w in self.postings.keys():
+            if word in w and w != word:
+                keys = self.postings.get(w)
+                if keys:
+                    found.update(keys)
+
+        return found
+
+    def candidates(self, patterns):
+        """Return set of keys that could contain all patterns, or None if
+        the patterns have no words we can use, meaning that all notes are
+        candidates.
+
+        @param patterns: list of (multi-)word patterns.
+        """
+
+        result = None
+
+        for p in patterns:
+            for word in word_re.findall(normalise_text(p)):
+                keys = self._keys_for_word(word)
+                result = keys if result is None else result & keys
+
+                if not result:
+                    # nothing can match, no need to look any further.
+                    return result
+
+        return result
+
+def trigrams(text):
+    return frozenset(text[i:i+3] for i in xrange(len(text) - 2))
+
+class TrigramIndex(TermIndex):
+    """Index of all lowercased three character sequences in each note.
+
+    This is used to prune the notes that have to be searched with a
+    regular expression, see regexp_query().
+    """
+
+    def terms(self, content):
+        return trigrams(normalise_text(content))
+
+    def _keys_for_literal(self, literal):
+        result = None
+        for t in trigrams(normalise_text(literal)):
+            keys = self.keys_for_term(t)
+            result = keys if result is None else result & keys
+            if not result:
+                break
+
+        return result
+
+    def candidates(self, query):
+        """Return set of keys of notes that could satisfy query, or None
+        if query is None, meaning that all notes are candidates.
+
+        @param query: as returned by regexp_query().
+        """
+
+        if query is None:
+            return None
+
+        elif isinstance(query, basestring):
+            return self._keys_for_literal(query)
+
+        op, subqueries = query
+        result = None
+        for q in subqueries:
+            keys = self.candidates(q)
+            if result is None:
+                result = keys
+
+            elif op == 'and':
+                result &= keys
+
+            else:
+                result |= keys
+
+            if op == 'and' and not result:
+                break
+
+        return result
+
+def _seq_query(subpattern, str_pattern):
+    """Return query for a parsed (sub-)expression. See regexp_query().
+    """
+
+    required = []
+    literal = []
+
+    def flush():
+        if len(literal) >= 3:
+            required.append(u''.join(literal))
+
+        del literal[:]
+
+    for op, av in subpattern:
+        if op == sre_constants.LITERAL and not (str_pattern and av > 127):
+            literal.append(unichr(av))
+            continue
+
+        flush()
+
+        if op == sre_constants.SUBPATTERN:
+            q = _seq_query(av[1], str_pattern)
+
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            q = _seq_query(av[2], str_pattern)
+
+        elif op == sre_constants.ASSERT:
+            # positive lookahead / lookbehind also has to be in the note
+            q = _seq_query(av[1], str_pattern)
+
+        elif op == sre_constants.BRANCH:
+            alternatives = [_seq_query(a, str_pattern) for a in av[1]]
+            # if any alternative can match without literals, so can the branch
+            q = None if None in alternatives else ('or', alternatives)
+
+        else:
+            q = None
+
+        if q is not None:
+            required.append(q)
+
+    flush()
+
+    if not required:
+        return None
+
+    elif len(required) == 1:
+        return required[0]
+
+    else:
+        return ('and', required)
+
+def regexp_query(pat):
+    """Determine which literal strings a note has to contain to be matched
+    by the compiled regular expression pat.
+
+    @returns: None if we could not find any required literals, else a
+    literal string, or a tuple ('and', [queries]) or ('or', [queries]).
+    The literals are not case folded, every index has to fold them the same
+    way as it folds the note content.
+    """
+
+    try:
+        parsed = sre_parse.parse(pat.pattern, pat.flags)
+
+    except (sre_constants.error, OverflowError, RuntimeError):
+        return None
+
+    # byte string patterns don't map non-ascii characters one-to-one onto
+    # the unicode note content.
+    return _seq_query(parsed, isinstance(pat.pattern, str))
@@ -0,0 +1,1305 @@
+# nvPY: cross-platform note-taking app with simplenote syncing
+# copyright 2012 by Charl P. Botha <cpbotha@vxlabs.com>
+# new BSD license
+
+"""Storage backends that NotesDB uses to keep its notes on disc.
+
+All stores have the interface of NoteStore: load() returns all notes, and
+save() and delete() write changes for a single note. Select one with the
+storage option in the config file, see open_store().
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import copy
+import cPickle
+import glob
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import stat
+import tempfile
+from threading import Lock, RLock, local
+import time
+import utils
+
+try:
+    import sqlite3
+except ImportError:
+    HAVE_SQLITE3 = False
+else:
+    HAVE_SQLITE3 = True
+
+def _new_file_mode():
+    # there is no way to read the umask without setting it
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0666 & ~umask
+
+# mode of files created with open(), while no other threads are running yet
+NEW_FILE_MODE = _new_file_mode()
+
+class ReadError(RuntimeError):
+    pass
+
+class WriteError(RuntimeError):
+    pass
+
+def replace_file(src, dst):
+    """Rename src to dst, replacing dst if it exists.
+    """
+
+    try:
+        os.rename(src, dst)
+
+    except OSError:
+        # on windows, rename does not replace existing files.
+        os.unlink(dst)
+        os.rename(src, dst)
+
+def fsync_dir(path):
+    """Make renames and deletes in directory path durable.
+
+    Not every platform can open a directory, windows for one. There the
+    file system takes care of it, so we ignore errors.
+    """
+
+    try:
+        fd = os.open(path, os.O_RDONLY)
+
+    except OSError:
+        return
+
+    try:
+        os.fsync(fd)
+
+    except OSError:
+        pass
+
+    finally:
+        os.close(fd)
+
+def migrate_json_notes(db_path, store):
+    """Copy the notes of a JsonStore in db_path into store, and then move
+    the JSON files to the backup directory.
+
+    Used the first time a store other than JsonStore is selected.
+    """
+
+    json_store = JsonStore(db_path)
+    fnlist = glob.glob(json_store.key_to_fname('*'))
+    if not fnlist:
+        return
+
+    logging.info('Migrating %d JSON notes to %s' % (len(fnlist), store.__class__.__name__))
+    notes = json_store.load()
+    mtimes = dict((k, json_store.get_mtime(k)) for k in notes)
+
+    try:
+        store.import_notes(notes, mtimes)
+
+        # only now that the notes are safely in the new store, move the old
+        # files out of the way.
+        backup_dir = os.path.join(db_path, NoteStore.BACKUP_DIR)
+        if not os.path.exists(backup_dir):
+            os.mkdir(backup_dir)
+
+        for fn in fnlist:
+            replace_file(fn, os.path.join(backup_dir, os.path.basename(fn)))
+
+    except (IOError, OSError), e:
+        logging.error('NotesDB_init: Error migrating notes: %s' % (str(e),))
+        raise ReadError ('Error migrating note files')
+
+def to_unicode(s):
+    if isinstance(s, str):
+        return unicode(s, 'utf-8', 'replace')
+
+    return s
+
+class NoteStore:
+    """Interface of all note stores.
+
+    @ivar fts: True if the store can do full-text searches, see
+    gstyle_candidates() and regexp_candidates().
+    @ivar lazy: True if load() returns LazyNote instances.
+    """
+
+    # where migrate_json_notes() puts the JSON files
+    BACKUP_DIR = 'json_backup'
+
+    fts = False
+    lazy = False
+
+    def __init__(self):
+        # per thread, the save thread and the main thread both write
+        self.tx = local()
+
+    def load(self):
+        """Read all notes.
+
+        @returns: dict mapping local key to note dict.
+        """
+        raise NotImplementedError
+
+    def get_mtime(self, k):
+        """Return timestamp of the last time note k was written to disc.
+        """
+        raise NotImplementedError
+
+    def save(self, k, note):
+        raise NotImplementedError
+
+    def delete(self, k):
+        raise NotImplementedError
+
+    def import_notes(self, notes, mtimes):
+        """Write all notes to a new, empty store.
+        """
+        for k, n in notes.items():
+            self.save(k, n)
+
+    @contextmanager
+    def transaction(self):
+        """Group the saves and deletes done in the with block, if the store
+        supports it.
+
+        Transactions can be nested, commit() is called when the outermost
+        one ends without an exception.
+        """
+
+        self.tx.depth = self.in_transaction() + 1
+        try:
+            yield
+
+        finally:
+            self.tx.depth -= 1
+
+        if not self.tx.depth:
+            self.commit()
+
+    def in_transaction(self):
+        """Return the transaction nesting depth of the calling thread.
+        """
+        return getattr(self.tx, 'depth', 0)
+
+    def commit(self):
+        """Make all writes so far durable. Stores call this after every
+        save or delete outside of a transaction.
+        """
+        pass
+
+    def _written(self):
+        if not self.in_transaction():
+            self.commit()
+
+    def note_saved(self, k):
+        """Called by NotesDB when note k in memory is known to be the same
+        as the saved version.
+        """
+        pass
+
+    def note_rekeyed(self, old_key, new_key):
+        """Called by NotesDB before note old_key gets new local key new_key.
+        """
+        pass
+
+    def snapshot_due(self):
+        """Return True if it's a good time to call write_snapshot().
+        """
+        return False
+
+    def write_snapshot(self, notes):
+        """Write a snapshot of notes that speeds up the next load(), if the
+        store supports it. Only call this when all notes have been saved.
+        """
+        pass
+
+    def gstyle_candidates(self, tag_pats, msword_pats):
+        """Return set of keys of the saved notes that could match the
+        gstyle patterns, or None if all notes could.
+        """
+        return None
+
+    def regexp_candidates(self, query):
+        """Return set of keys of the saved notes that could match query as
+        returned by notes_index.regexp_query(), or None if all notes could.
+        """
+        return None
+
+    def close(self):
+        pass
+
+def read_json_file(fn):
+    """Return (decoded JSON, (size, mtime)) of file fn.
+    """
+
+    try:
+        with open(fn, 'rb') as f:
+            st = os.fstat(f.fileno())
+            return json.load(f), (st.st_size, st.st_mtime)
+
+    except IOError, e:
+        logging.error('NotesDB_init: Error opening %s: %s' % (fn, str(e)))
+        raise ReadError ('Error opening note file')
+
+    except ValueError, e:
+        logging.error('NotesDB_init: Error reading %s: %s' % (fn, str(e)))
+        raise ReadError ('Error reading note file')
+
+class JsonStore(NoteStore):
+    """One indented JSON file per note, named after the note's local key.
+
+    This is the original nvPY storage layout.
+
+    To speed up startup, we write a snapshot of all notes and the size and
+    mtime of their files once everything has been saved, see
+    write_snapshot(). load() then only has to read the files that don't
+    match the snapshot anymore.
+
+    @ivar stats: dict mapping key to (size, mtime) of its file, as it was
+    when we last read or wrote it.
+    @ivar snapshot_stale: True if notes have been written since the last
+    snapshot.
+    @ivar dir_dirty: True if files have been renamed or deleted since the
+    last fsync of db_path.
+
+    Every note is written to a temporary file that is fsynced and then
+    renamed over the old file, so a crash can't leave a truncated note
+    behind. The directory itself is only fsynced by commit(), so a batch of
+    saves in a transaction costs one directory fsync.
+    """
+
+    SNAPSHOT_FNAME = 'notes.snapshot'
+    SNAPSHOT_VERSION = 1
+
+    # seconds without saves before snapshot_due()
+    SNAPSHOT_IDLE_S = 30
+
+    # files modified this close to the snapshot could have been changed
+    # again without a different mtime, on file systems with coarse
+    # timestamps. we read those anyway.
+    SNAPSHOT_RACY_S = 2
+
+    # with this many notes or more, we read them with a pool of threads,
+    # so that the OS can fetch files in parallel on a cold cache.
+    PARALLEL_LOAD_MIN = 64
+    LOAD_THREADS = 8
+
+    def __init__(self, db_path):
+        NoteStore.__init__(self)
+        self.db_path = db_path
+        self.snapshot_fname = os.path.join(db_path, self.SNAPSHOT_FNAME)
+        self.stats = {}
+        self.snapshot_stale = False
+        self.last_change = 0
+        self.dir_dirty = False
+
+    def key_to_fname(self, k):
+        return os.path.join(self.db_path, k) + '.json'
+
+    def fname_to_key(self, fn):
+        return os.path.splitext(os.path.basename(fn))[0]
+
+    def load(self):
+        # left behind by a crash during save(), the note files themselves
+        # are still complete.
+        for fn in glob.glob(self.key_to_fname('*') + '.tmp'):
+            logging.warning('NotesDB_init: Removing stale %s' % (fn,))
+            try:
+                os.unlink(fn)
+
+            except OSError, e:
+                logging.error('NotesDB_init: Error removing %s: %s' % (fn, str(e)))
+
+        snapshot = self._read_snapshot()
+        snapshot_stats = snapshot['stats']
+        snapshot_notes = snapshot['notes']
+        racy_mtime = snapshot['time'] - self.SNAPSHOT_RACY_S
+
+        notes = {}
+        self.stats = {}
+        fnlist = []
+        for fn in glob.glob(self.key_to_fname('*')):
+            # we always have a localkey, also when we don't have a note['key'] yet (no sync)
+            localkey = self.fname_to_key(fn)
+            try:
+                st = os.stat(fn)
+
+            except OSError:
+                # let read_json_file() report the problem
+                fnlist.append(fn)
+                continue
+
+            stat = (st.st_size, st.st_mtime)
+            if localkey in snapshot_notes and snapshot_stats.get(localkey) == stat and \
+               st.st_mtime < racy_mtime:
+                notes[localkey] = snapshot_notes[localkey]
+                self.stats[localkey] = stat
+
+            else:
+                fnlist.append(fn)
+
+        if len(fnlist) >= self.PARALLEL_LOAD_MIN:
+            pool = ThreadPool(self.LOAD_THREADS)
+            try:
+                # the first ReadError in any of the threads is raised here
+                results = pool.map(read_json_file, fnlist)
+
+            finally:
+                pool.terminate()
+
+        else:
+            results = [read_json_file(fn) for fn in fnlist]
+
+        for fn, (n, stat) in zip(fnlist, results):
+            localkey = self.fname_to_key(fn)
+            notes[localkey] = n
+            self.stats[localkey] = stat
+
+        self.snapshot_stale = bool(fnlist) or len(notes) != len(snapshot_notes)
+
+        return notes
+
+    def _read_snapshot(self):
+        empty = {'time' : 0, 'stats' : {}, 'notes' : {}}
+        if not os.path.exists(self.snapshot_fname):
+            return empty
+
+        try:
+            with open(self.snapshot_fname, 'rb') as f:
+                snapshot = cPickle.load(f)
+
+        except Exception, e:
+            # the snapshot is only a cache, the note files are what counts.
+            logging.warning('NotesDB_init: Ignoring snapshot %s: %s' % (self.snapshot_fname, str(e)))
+            return empty
+
+        if not isinstance(snapshot, dict) or snapshot.get('version') != self.SNAPSHOT_VERSION:
+            return empty
+
+        return snapshot
+
+    def snapshot_due(self):
+        return self.snapshot_stale and \
+               time.time() - self.last_change > self.SNAPSHOT_IDLE_S
+
+    def write_snapshot(self, notes):
+        """Write snapshot of notes, which have to be exactly as they are
+        in their files.
+        """
+
+        if not self.snapshot_stale:
+            return
+
+        snapshot = {'version' : self.SNAPSHOT_VERSION,
+                    'time' : time.time(),
+                    'stats' : dict(self.stats)}
+        snapshot['notes'] = dict((k, notes[k]) for k in snapshot['stats'] if k in notes)
+
+        tmp_fname = self.snapshot_fname + '.tmp'
+        try:
+            with open(tmp_fname, 'wb') as f:
+                cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
+
+            replace_file(tmp_fname, self.snapshot_fname)
+
+        except (IOError, OSError, cPickle.PicklingError), e:
+            logging.warning('NotesDB: Could not write snapshot %s: %s' % (self.snapshot_fname, str(e)))
+
+        else:
+            self.snapshot_stale = False
+
+    def get_mtime(self, k):
+        stat = self.stats.get(k)
+        if stat is None:
+            return os.path.getmtime(self.key_to_fname(k))
+
+        return stat[1]
+
+    def _changed(self):
+        self.snapshot_stale = True
+        self.last_change = time.time()
+
+    def save(self, k, note):
+        self._changed()
+        fn = self.key_to_fname(k)
+        try:
+            # the save thread and a full sync can write the same note at
+            # the same time, each needs its own temporary file.
+            fd, tmp_fname = tempfile.mkstemp(prefix=k + '.', suffix='.json.tmp', dir=self.db_path)
+            with os.fdopen(fd, 'wb') as f:
+                json.dump(note, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+                st = os.fstat(f.fileno())
+
+            # mkstemp() files are only readable by us, the note file keeps
+            # the mode it had or would have had with open().
+            try:
+                mode = stat.S_IMODE(os.stat(fn).st_mode)
+
+            except OSError:
+                mode = NEW_FILE_MODE
+
+            os.chmod(tmp_fname, mode)
+            replace_file(tmp_fname, fn)
+            self.stats[k] = (st.st_size, st.st_mtime)
+
+        except (IOError, OSError), e:
+            self.stats.pop(k, None)
+            logging.error('NotesDB_save: Error writing %s: %s' % (fn, str(e)))
+            raise WriteError ('Error writing note file')
+
+        self.dir_dirty = True
+        self._written()
+
+    def delete(self, k):
+        self._changed()
+        self.stats.pop(k, None)
+        fn = self.key_to_fname(k)
+        if os.path.isfile(fn):
+            os.unlink(fn)
+            self.dir_dirty = True
+            self._written()
+
+    def commit(self):
+        if self.dir_dirty:
+            # clear the flag first: a rename by another thread after this
+            # point is still covered by the fsync below.
+            self.dir_dirty = False
+            fsync_dir(self.db_path)
+
+class LogStore(NoteStore):
+    """All notes in a single append-only file.
+
+    Every save appends one line with the JSON encoded note to the log, a
+    delete appends a line with a null note. When reading the log, the last
+    line for a key wins. We keep the offset of each key's latest line, so that
+    the log can be compacted by copying just those lines to a new file, which
+    happens when most of the log has been superseded.
+
+    The first time the log store is used, the notes in the JSON files of
+    JsonStore are migrated, see migrate_json_notes().
+
+    @ivar index: dict mapping key to (offset, length, mtime) of the latest
+    line of that note in the log.
+    @ivar live_bytes: number of bytes in the log taken by the latest lines.
+    @ivar log_bytes: total size of the log.
+    """
+
+    LOG_FNAME = 'notes.log'
+
+    # don't bother compacting logs smaller than this
+    COMPACT_MIN_BYTES = 1024 * 1024
+
+    def __init__(self, db_path):
+        NoteStore.__init__(self)
+        self.db_path = db_path
+        self.log_fname = os.path.join(db_path, self.LOG_FNAME)
+        self.index = {}
+        self.live_bytes = 0
+        self.log_bytes = 0
+        self.f = None
+        # saves come from the save thread as well as the main thread
+        self.lock = Lock()
+
+    def load(self):
+        if not os.path.exists(self.log_fname):
+            migrate_json_notes(self.db_path, self)
+
+        notes = {}
+        self.index = {}
+        self.live_bytes = 0
+
+        try:
+            f = open(self.log_fname, 'a+b')
+            f.seek(0)
+
+            offset = 0
+            for line in f:
+                if not line.endswith('\n'):
+                    # partial line from a crash while appending, ignore it.
+                    logging.warning('NotesDB_init: Ignoring incomplete last line in %s' % (self.log_fname,))
+                    f.truncate(offset)
+                    break
+
+                r = json.loads(line)
+                self._index_record(r, offset, len(line))
+                if r['note'] is None:
+                    notes.pop(r['key'], None)
+
+                else:
+                    notes[r['key']] = r['note']
+
+                offset += len(line)
+
+        except IOError, e:
+            logging.error('NotesDB_init: Error opening %s: %s' % (self.log_fname, str(e)))
+            raise ReadError ('Error opening note file')
+
+        except (ValueError, KeyError), e:
+            logging.error('NotesDB_init: Error reading %s: %s' % (self.log_fname, str(e)))
+            raise ReadError ('Error reading note file')
+
+        self.f = f
+        self.log_bytes = offset
+        self._compact_if_needed()
+
+        return notes
+
+    def get_mtime(self, k):
+        return self.index[k][2]
+
+    def save(self, k, note):
+        self._append(k, note)
+
+    def delete(self, k):
+        if k in self.index:
+            self._append(k, None)
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+    def _index_record(self, r, offset, length):
+        old = self.index.get(r['key'])
+        if old is not None:
+            self.live_bytes -= old[1]
+
+        if r['note'] is None:
+            # a delete line is garbage as soon as it has been written
+            self.index.pop(r['key'], None)
+
+        else:
+            self.index[r['key']] = (offset, length, r['mtime'])
+            self.live_bytes += length
+
+    def _append(self, k, note):
+        r = {'key' : k, 'mtime' : time.time(), 'note' : note}
+        line = json.dumps(r) + '\n'
+
+        with self.lock:
+            try:
+                self.f.seek(0, os.SEEK_END)
+                self.f.write(line)
+                self.f.flush()
+
+            except (IOError, OSError), e:
+                logging.error('NotesDB_save: Error writing %s: %s' % (self.log_fname, str(e)))
+                raise WriteError ('Error writing note file')
+
+            self._index_record(r, self.log_bytes, len(line))
+            self.log_bytes += len(line)
+            self._compact_if_needed()
+
+        self._written()
+
+    def commit(self):
+        with self.lock:
+            if self.f is None:
+                return
+
+            try:
+                os.fsync(self.f.fileno())
+
+            except OSError, e:
+                logging.error('NotesDB_save: Error writing %s: %s' % (self.log_fname, str(e)))
+                raise WriteError ('Error writing note file')
+
+    def _compact_if_needed(self):
+        """Rewrite the log with only the latest line of each note once more
+        than half of it is garbage. Caller has to hold the lock, except
+        during load().
+        """
+
+        if self.log_bytes < self.COMPACT_MIN_BYTES or \
+           self.log_bytes < 2 * self.live_bytes:
+            return
+
+        logging.debug('Compacting %s: %d of %d bytes in use' % (self.log_fname, self.live_bytes, self.log_bytes))
+
+        tmp_fname = self.log_fname + '.tmp'
+        new_index = {}
+        offset = 0
+        try:
+            with open(tmp_fname, 'wb') as tf:
+                # in log order, so that the new log also reads sequentially
+                for k, (o, length, mtime) in sorted(self.index.items(), key=lambda i: i[1][0]):
+                    self.f.seek(o)
+                    tf.write(self.f.read(length))
+                    new_index[k] = (offset, length, mtime)
+                    offset += length
+
+                tf.flush()
+                os.fsync(tf.fileno())
+
+            self.f.close()
+            replace_file(tmp_fname, self.log_fname)
+            fsync_dir(self.db_path)
+
+        except (IOError, OSError), e:
+            logging.error('NotesDB_save: Error compacting %s: %s' % (self.log_fname, str(e)))
+            raise WriteError ('Error writing note file')
+
+        self.f = open(self.log_fname, 'a+b')
+        self.index = new_index
+        self.live_bytes = self.log_bytes = offset
+
+    def import_notes(self, notes, mtimes):
+        tmp_fname = self.log_fname + '.tmp'
+        with open(tmp_fname, 'wb') as tf:
+            for k, n in notes.items():
+                r = {'key' : k, 'mtime' : mtimes[k], 'note' : n}
+                tf.write(json.dumps(r) + '\n')
+
+            tf.flush()
+            os.fsync(tf.fileno())
+
+        replace_file(tmp_fname, self.log_fname)
+        fsync_dir(self.db_path)
+
+class LazyNote(dict):
+    """Note dict of which the content is only read from the store when
+    it's used.
+
+    The store can drop the content again with unload(), as long as it has
+    not been changed since the note was saved. The search thread can load
+    or unload the content while the main thread changes it, so all three
+    happen with the lock of the store held.
+
+    @ivar title: title of the note as it was saved, so that we don't need
+    the content for it. None once the content has been changed.
+    @ivar modified: True if the content has been changed since it was saved.
+    """
+
+    def __init__(self, store, k, fields, title):
+        dict.__init__(self, fields)
+        self.store = store
+        self.k = k
+        self.title = title
+        self.modified = False
+
+    def _content(self):
+        with self.store.lock:
+            try:
+                c = dict.__getitem__(self, 'content')
+
+            except KeyError:
+                c = self.store.get_content(self.k)
+                dict.__setitem__(self, 'content', c)
+
+            self.store.content_used(self.k, self)
+
+        return c
+
+    def unload(self):
+        with self.store.lock:
+            if not self.modified:
+                dict.pop(self, 'content', None)
+
+    def __getitem__(self, key):
+        if key == 'content':
+            return self._content()
+
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key == 'content':
+            c = self._content()
+            return default if c is None else c
+
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        return key == 'content' or dict.__contains__(self, key)
+
+    def __setitem__(self, key, value):
+        if key == 'content':
+            with self.store.lock:
+                self.modified = True
+                self.title = None
+                dict.__setitem__(self, key, value)
+
+        else:
+            dict.__setitem__(self, key, value)
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        if 'content' in other:
+            with self.store.lock:
+                self.modified = True
+                self.title = None
+                dict.update(self, other)
+
+        else:
+            dict.update(self, other)
+
+    # everything that iterates over the whole note needs the content
+
+    def __iter__(self):
+        self._content()
+        return dict.__iter__(self)
+
+    def keys(self):
+        self._content()
+        return dict.keys(self)
+
+    def items(self):
+        self._content()
+        return dict.items(self)
+
+    def iteritems(self):
+        self._content()
+        return dict.iteritems(self)
+
+    def values(self):
+        self._content()
+        return dict.values(self)
+
+    def copy(self):
+        self._content()
+        return dict(dict.items(self))
+
+    def __deepcopy__(self, memo):
+        # copies are plain note dicts
+        return copy.deepcopy(self.copy(), memo)
+
+class SQLiteStore(NoteStore):
+    """All notes in a single SQLite database, notes.db.
+
+    The note metadata that we query on has its own columns, any other fields
+    that the server sends us go into the extra column as JSON. Tags are also
+    in the note_tags table, and if SQLite has FTS5 with the trigram tokenizer,
+    content is also in the notes_fts full-text index, which we use to find
+    candidates for searches.
+
+    In lazy mode, load() returns LazyNote instances without their content.
+    At most LAZY_CACHE_SIZE notes keep their content in memory, apart from
+    notes that have been changed and not saved yet.
+
+    Like LogStore, the first use migrates the JSON notes of JsonStore.
+    """
+
+    DB_FNAME = 'notes.db'
+
+    # note fields that have their own column
+    COLUMNS = ['key', 'content', 'modifydate', 'createdate', 'syncdate',
+               'savedate', 'syncnum', 'version', 'deleted']
+    JSON_COLUMNS = ['tags', 'systemtags']
+
+    LAZY_CACHE_SIZE = 500
+
+    def __init__(self, db_path, lazy=False):
+        NoteStore.__init__(self)
+        self.db_path = db_path
+        self.db_fname = os.path.join(db_path, self.DB_FNAME)
+        self.lazy = lazy
+        self.conn = None
+        # the save, search and main threads all use the same connection, so
+        # everything happens with this lock held.
+        self.lock = RLock()
+        self.transaction_depth = 0
+        # LazyNote instances by local key, and the ones that have their
+        # content loaded in least recently used order.
+        self.lazy_notes = {}
+        self.loaded = OrderedDict()
+
+    def load(self):
+        new_db = not os.path.exists(self.db_fname)
+
+        try:
+            # we do our own transactions
+            self.conn = sqlite3.connect(self.db_fname, check_same_thread=False,
+                                        isolation_level=None)
+            self._create_tables()
+
+            if new_db:
+                migrate_json_notes(self.db_path, self)
+
+            notes = {}
+            columns = ['localkey', 'mtime', 'extra', 'title'] + self.COLUMNS + self.JSON_COLUMNS
+            if self.lazy:
+                columns.remove('content')
+
+            with self.lock:
+                rows = self.conn.execute('SELECT %s FROM notes' % (', '.join(columns),)).fetchall()
+
+            for row in rows:
+                n = json.loads(row[2]) if row[2] else {}
+                for c, v in zip(columns[4:], row[4:]):
+                    if v is not None:
+                        n[c] = json.loads(v) if c in self.JSON_COLUMNS else v
+
+                if self.lazy:
+                    n = LazyNote(self, row[0], n, row[3])
+                    self.lazy_notes[row[0]] = n
+
+                notes[row[0]] = n
+
+        except sqlite3.Error, e:
+            logging.error('NotesDB_init: Error reading %s: %s' % (self.db_fname, str(e)))
+            raise ReadError ('Error reading note database')
+
+        return notes
+
+    def _create_tables(self):
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS notes ('
+                              'localkey TEXT PRIMARY KEY, mtime REAL, extra TEXT, '
+                              'key TEXT, content TEXT, modifydate REAL, createdate REAL, '
+                              'syncdate REAL, savedate REAL, syncnum INTEGER, '
+                              'version INTEGER, deleted INTEGER, tags TEXT, systemtags TEXT)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS note_tags ('
+                              'localkey TEXT, tag TEXT)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS note_tags_tag ON note_tags (tag)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS note_tags_localkey ON note_tags (localkey)')
+
+            columns = [r[1] for r in self.conn.execute('PRAGMA table_info(notes)')]
+            if 'title' not in columns:
+                # databases from before we stored titles
+                self.conn.execute('ALTER TABLE notes ADD COLUMN title TEXT')
+                rows = self.conn.execute('SELECT localkey, content FROM notes').fetchall()
+                self.conn.executemany('UPDATE notes SET title = ? WHERE localkey = ?',
+                                      [(utils.get_note_title({'content' : c or u''}), k) for k, c in rows])
+
+            try:
+                # rowid is the rowid of the note in the notes table
+                self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts "
+                                  "USING fts5(content, tokenize='trigram')")
+
+            except sqlite3.OperationalError, e:
+                logging.warning('SQLite without FTS5 trigram support, not using full-text search: %s' % (str(e),))
+                self.fts = False
+
+            else:
+                self.fts = True
+
+    def get_mtime(self, k):
+        with self.lock:
+            return self.conn.execute('SELECT mtime FROM notes WHERE localkey = ?', (k,)).fetchone()[0]
+
+    def get_content(self, k):
+        with self.lock:
+            row = self.conn.execute('SELECT content FROM notes WHERE localkey = ?', (k,)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def content_used(self, k, note):
+        """Called by LazyNote whenever its content is used.
+        """
+
+        with self.lock:
+            self.loaded.pop(k, None)
+            self.loaded[k] = note
+
+            if len(self.loaded) > self.LAZY_CACHE_SIZE:
+                # modified notes stay until they have been saved
+                for lk, n in self.loaded.items():
+                    if not n.modified:
+                        n.unload()
+                        del self.loaded[lk]
+
+                        if len(self.loaded) <= self.LAZY_CACHE_SIZE:
+                            break
+
+    def note_saved(self, k):
+        n = self.lazy_notes.get(k)
+        if n is not None:
+            with self.lock:
+                n.modified = False
+
+    def note_rekeyed(self, old_key, new_key):
+        n = self.lazy_notes.pop(old_key, None)
+        if n is not None:
+            with self.lock:
+                # we won't find the content under the old key anymore
+                n._content()
+                n.modified = True
+                n.k = new_key
+
+            self.lazy_notes[new_key] = n
+
+    def save(self, k, note):
+        extra = dict((f, v) for f, v in note.items()
+                     if f not in self.COLUMNS and f not in self.JSON_COLUMNS)
+        values = [to_unicode(note.get(c)) for c in self.COLUMNS]
+        values += [json.dumps(note[c]) if c in note else None for c in self.JSON_COLUMNS]
+
+        with self.transaction():
+            self._delete(k)
+            self.conn.execute('INSERT INTO notes (localkey, mtime, extra, title, %s) VALUES (?, ?, ?, ?, %s)' %
+                              (', '.join(self.COLUMNS + self.JSON_COLUMNS),
+                               ', '.join('?' * len(values))),
+                              [k, time.time(), json.dumps(extra), utils.get_note_title(note)] + values)
+
+            rowid = self.conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+            if self.fts:
+                self.conn.execute('INSERT INTO notes_fts (rowid, content) VALUES (?, ?)',
+                                  (rowid, to_unicode(note.get('content')) or u''))
+
+            self.conn.executemany('INSERT INTO note_tags (localkey, tag) VALUES (?, ?)',
+                                  [(k, to_unicode(t)) for t in note.get('tags') or []])
+
+    def delete(self, k):
+        with self.transaction():
+            self._delete(k)
+
+    def _delete(self, k):
+        row = self.conn.execute('SELECT rowid FROM notes WHERE localkey = ?', (k,)).fetchone()
+        if row is not None:
+            if self.fts:
+                self.conn.execute('DELETE FROM notes_fts WHERE rowid = ?', row)
+
+            self.conn.execute('DELETE FROM notes WHERE rowid = ?', row)
+            self.conn.execute('DELETE FROM note_tags WHERE localkey = ?', (k,))
+
+    def import_notes(self, notes, mtimes):
+        with self.transaction():
+            for k, n in notes.items():
+                self.save(k, n)
+                self.conn.execute('UPDATE notes SET mtime = ? WHERE localkey = ?', (mtimes[k], k))
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            # transactions can be nested, only the outermost one counts.
+            self.transaction_depth += 1
+            try:
+                if self.transaction_depth == 1:
+                    self.conn.execute('BEGIN')
+
+                try:
+                    yield
+
+                except:
+                    if self.transaction_depth == 1:
+                        self.conn.execute('ROLLBACK')
+                    raise
+
+                else:
+                    if self.transaction_depth == 1:
+                        self.conn.execute('COMMIT')
+
+            except sqlite3.Error, e:
+                logging.error('NotesDB_save: Error writing %s: %s' % (self.db_fname, str(e)))
+                raise WriteError ('Error writing note database')
+
+            finally:
+                self.transaction_depth -= 1
+
+    def _candidates(self, selects, params):
+        if not selects:
+            return None
+
+        with self.lock:
+            rows = self.conn.execute(' INTERSECT '.join(selects), params).fetchall()
+
+        return set(r[0] for r in rows)
+
+    def gstyle_candidates(self, tag_pats, msword_pats):
+        # without the full-text index, NotesDB uses its own word index
+        if not self.fts:
+            return None
+
+        selects = []
+        params = []
+
+        # the trigram tokenizer can only find strings of 3 or more characters
+        phrases = [fts_phrase(p) for p in msword_pats if len(to_unicode(p)) >= 3]
+        if phrases:
+            selects.append('SELECT localkey FROM notes JOIN notes_fts '
+                           'ON notes.rowid = notes_fts.rowid WHERE notes_fts MATCH ?')
+            params.append(u' AND '.join(phrases))
+
+        if self.lazy:
+            # we don't want to load the content of all notes for patterns
+            # that are too short for the full-text index. LIKE is case
+            # insensitive for ascii, so it finds a superset of the notes.
+            for p in msword_pats:
+                p = to_unicode(p)
+                if len(p) < 3 and all(ord(c) < 128 for c in p):
+                    selects.append("SELECT localkey FROM notes WHERE content LIKE ? ESCAPE '\\'")
+                    params.append(u'%%%s%%' % (like_escape(p),))
+
+        for tp in tag_pats:
+            # tag starts with tp, GLOB can use the index for this
+            selects.append('SELECT localkey FROM note_tags WHERE tag GLOB ?')
+            params.append(glob_escape(to_unicode(tp)) + u'*')
+
+        return self._candidates(selects, params)
+
+    def regexp_candidates(self, query):
+        if not self.fts or query is None:
+            return None
+
+        return self._candidates(['SELECT localkey FROM notes JOIN notes_fts '
+                                 'ON notes.rowid = notes_fts.rowid WHERE notes_fts MATCH ?'],
+                                [fts_query(query)])
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+def fts_phrase(s):
+    """Return FTS5 query string matching s, which the trigram tokenizer
+    does as a (case insensitive) substring search.
+    """
+
+    return u'"%s"' % (to_unicode(s).replace(u'"', u'""'),)
+
+def fts_query(query):
+    """Convert query as returned by notes_index.regexp_query() to FTS5.
+    """
+
+    if isinstance(query, basestring):
+        return fts_phrase(query)
+
+    op, subqueries = query
+    op = u' AND ' if op == 'and' else u' OR '
+    return u'(%s)' % (op.join(fts_query(q) for q in subqueries),)
+
+def like_escape(s):
+    return s.replace(u'\\', u'\\\\').replace(u'%', u'\\%').replace(u'_', u'\\_')
+
+def glob_escape(s):
+    # a special character between brackets is matched literally
+    return u''.join(u'[%s]' % (c,) if c in u'*?[' else c for c in s)
+
+def text_splice(old, new):
+    """Return (at, remove, insert) so that
+    new == old[:at] + insert + old[at + remove:].
+
+    Edits are usually small and in one place, so we only look for the
+    common start and end of old and new. Comparing in chunks keeps this
+    fast for long notes.
+    """
+
+    chunk = 1024
+    n = min(len(old), len(new))
+
+    at = 0
+    while at < n:
+        end = min(at + chunk, n)
+        if old[at:end] != new[at:end]:
+            while old[at] == new[at]:
+                at += 1
+            break
+
+        at = end
+
+    # common end, which may not overlap with the common start
+    n -= at
+    lo = len(old)
+    ln = len(new)
+    s = 0
+    while s < n:
+        end = min(s + chunk, n)
+        if old[lo - end:lo - s] != new[ln - end:ln - s]:
+            while old[lo - s - 1] == new[ln - s - 1]:
+                s += 1
+            break
+
+        s = end
+
+    return at, lo - at - s, new[at:ln - s]
+
+class Journal:
+    """Append-only file with the changes to notes that may not have been
+    saved yet.
+
+    NotesDB appends a record for every change the user makes, and clears
+    the journal once all notes have been saved. After a crash, replay()
+    returns the records, so that the changes can be applied again.
+
+    Records are dicts with at least key, op and modifydate. Content
+    changes are recorded as a splice of the previous content in the
+    journal, or the whole content for the first change of a note.
+
+    @ivar nbytes: size of the journal file.
+    @ivar dirty: True if records have been written since the last fsync.
+    @ivar failed: True after a write error, we stop journaling then.
+    """
+
+    FNAME = 'notes.journal'
+
+    def __init__(self, db_path):
+        self.fname = os.path.join(db_path, self.FNAME)
+        self.f = None
+        self.nbytes = 0
+        self.dirty = False
+        self.failed = False
+
+    def replay(self):
+        """Return list of the records in the journal, oldest first, and
+        open it for appending.
+        """
+
+        records = []
+        try:
+            f = open(self.fname, 'a+b')
+            f.seek(0)
+
+            offset = 0
+            for line in f:
+                try:
+                    if not line.endswith('\n'):
+                        raise ValueError('incomplete line')
+
+                    records.append(json.loads(line))
+
+                except ValueError, e:
+                    # a crash while appending. what came before is good.
+                    logging.warning('NotesDB_init: Ignoring end of %s: %s' % (self.fname, str(e)))
+                    f.truncate(offset)
+                    break
+
+                offset += len(line)
+
+        except IOError, e:
+            logging.error('NotesDB_init: Error opening %s: %s' % (self.fname, str(e)))
+            raise ReadError ('Error opening journal')
+
+        self.f = f
+        self.nbytes = offset
+
+        return records
+
+    def append(self, r):
+        """Write record r. This only has to be a cheap sequential write,
+        sync() makes it durable.
+        """
+
+        if self.failed:
+            return
+
+        line = json.dumps(r) + '\n'
+        try:
+            self.f.seek(0, os.SEEK_END)
+            self.f.write(line)
+            self.f.flush()
+
+        except (IOError, OSError, ValueError), e:
+            # the notes are still saved as usual, we only lose the
+            # protection against crashes.
+            logging.error('NotesDB: Error writing %s, journal disabled: %s' % (self.fname, str(e)))
+            self.failed = True
+            return
+
+        self.nbytes += len(line)
+        self.dirty = True
+
+    def sync(self):
+        if self.dirty and not self.failed:
+            try:
+                os.fsync(self.f.fileno())
+
+            except OSError, e:
+                logging.error('NotesDB: Error syncing %s: %s' % (self.fname, str(e)))
+
+            self.dirty = False
+
+    def clear(self):
+        """Throw away all records. Only call when all notes are saved.
+        """
+
+        if not self.nbytes or self.failed:
+            return
+
+        try:
+            self.f.truncate(0)
+
+        except IOError, e:
+            logging.error('NotesDB: Error clearing %s: %s' % (self.fname, str(e)))
+            return
+
+        self.nbytes = 0
+        self.dirty = False
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+class SyncCursor:
+    """What we knew about the notes on the server after the previous full
+    sync, so that the next one only has to ask for what changed since.
+
+    @ivar since: latest modifydate in the server's note list.
+    @ivar listdate: when we last got the server's complete note list.
+    """
+
+    FNAME = 'sync.cursor'
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.fname = os.path.join(db_path, self.FNAME)
+        self.since = None
+        self.listdate = None
+
+    def load(self):
+        """Read the cursor. Returns False if there is no usable cursor,
+        then we need the complete note list.
+        """
+
+        try:
+            with open(self.fname, 'rb') as f:
+                d = json.load(f)
+
+            self.since = float(d['since'])
+            self.listdate = float(d['listdate'])
+
+        except IOError, e:
+            # e.g. the first sync
+            return False
+
+        except (ValueError, KeyError, TypeError), e:
+            logging.warning('NotesDB_sync: Ignoring %s: %s' % (self.fname, str(e)))
+            return False
+
+        return True
+
+    def save(self):
+        tmp_fname = self.fname + '.tmp'
+        d = {'since' : self.since, 'listdate' : self.listdate}
+        try:
+            with open(tmp_fname, 'wb') as f:
+                json.dump(d, f)
+                f.flush()
+                os.fsync(f.fileno())
+
+            replace_file(tmp_fname, self.fname)
+
+        except (IOError, OSError), e:
+            # the next sync gets the complete list
+            logging.error('NotesDB_sync: Error writing %s: %s' % (self.fname, str(e)))
+            try:
+                os.unlink(self.fname)
+
+            except OSError:
+                pass
+
+def open_store(config):
+    """Return the store selected by config.storage for config.db_path.
+    """
+
+    if config.lazy_content and config.storage != 'sqlite':
+        logging.warning('lazy_content only works with storage = sqlite, ignoring it')
+
+    if config.storage == 'log':
+        return LogStore(config.db_path)
+
+    elif config.storage == 'sqlite':
+        if not HAVE_SQLITE3:
+            logging.error('NotesDB_init: storage = sqlite, but the sqlite3 module is not available')
+            raise ReadError ('sqlite3 module not available')
+
+        return SQLiteStore(config.db_path, lazy=config.lazy_content)
+
+    else:
+        return JsonStore(config.db_path)
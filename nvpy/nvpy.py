@@ -85,6 +85,9 @@ class Config:
                     'sort_mode' : '1',
                     'pinned_ontop' : '1',
                     'db_path' : os.path.join(home, '.nvpy'),
+                    'storage' : 'json',
+                    'lazy_content' : '0',
+                    'history_revisions' : '30',
                     'txt_path' : os.path.join(home, '.nvpy/notes'),
                     'font_family' : 'Courier', # monospaced on all platforms
                     'font_size' : '10',
@@ -97,6 +100,7 @@ class Config:
                     'sn_username' : '',
                     'sn_password' : '',
                     'simplenote_sync' : '1',
+                    'sync_concurrency' : '4',
                     # Filename or filepath to a css file used style the rendered
                     # output; e.g. nvpy.css or /path/to/my.css
                     'rest_css_path': None,
@@ -126,8 +130,17 @@ class Config:
         self.sn_username = cp.get(cfg_sec, 'sn_username', raw=True)
         self.sn_password = cp.get(cfg_sec, 'sn_password', raw=True)
         self.simplenote_sync = cp.getint(cfg_sec, 'simplenote_sync')
+        # number of notes that a full sync transfers at the same time
+        self.sync_concurrency = cp.getint(cfg_sec, 'sync_concurrency')
         # make logic to find in $HOME if not set
         self.db_path = cp.get(cfg_sec, 'db_path')
+        # json = one file per note, log = single append-only file,
+        # sqlite = SQLite database with full-text index
+        self.storage = cp.get(cfg_sec, 'storage')
+        # only read note content from the sqlite store when it's needed
+        self.lazy_content = cp.getint(cfg_sec, 'lazy_content')
+        # saved versions to keep of each note, 0 = no history
+        self.history_revisions = cp.getint(cfg_sec, 'history_revisions')
         #  0 = alpha sort, 1 = last modified first
         self.notes_as_txt = cp.getint(cfg_sec, 'notes_as_txt')
         self.txt_path = os.path.join(home, cp.get(cfg_sec, 'txt_path'))
@@ -157,32 +170,51 @@ class Config:
 class NotesListModel(SubjectMixin):
     """
     @ivar list: List of (str key, dict note) objects.
+    @ivar dirty_keys: dict used as set of keys of notes that have changed
+    since the view last checked if its notes list is out of date.
     """
     def __init__(self):
         # call mixin ctor
         SubjectMixin.__init__(self)
 
         self.list = []
+        self.key_to_idx = {}
+        self.dirty_keys = {}
         self.match_regexps = []
 
     def set_list(self, alist):
         self.list = alist
+        self.key_to_idx = dict((e.key, i) for i,e in enumerate(alist))
         self.notify_observers('set:list', None)
 
     def get_idx(self, key):
         """Find idx for passed LOCAL key.
         """
-        found = [i for i,e in enumerate(self.list) if e.key == key]
-        if found:
-            return found[0]
+        return self.key_to_idx.get(key, -1)
 
-        else:
-            return -1
+    def mark_dirty(self, key):
+        self.dirty_keys[key] = True
+
+    def pop_dirty_keys(self):
+        """Return list of keys marked dirty, and forget about them.
+        """
+        keys = self.dirty_keys.keys()
+        self.dirty_keys = {}
+        return keys
 
 class Controller:
     """Main application class.
     """
 
+    # how often we check if the background search has delivered its result
+    FILTER_POLL_INTERVAL_MS = 20
+
+    # how often we pick up changes to the text files of the notes
+    TXT_POLL_INTERVAL_MS = 500
+
+    # how often we check on the background full sync
+    SYNC_FULL_POLL_INTERVAL_MS = 100
+
     def __init__(self):
         # setup appdir
         if hasattr(sys, 'frozen') and sys.frozen:
@@ -238,6 +270,11 @@ class Controller:
                 self.config.rest_css_path = None
 
         self.notes_list_model = NotesListModel()
+        # generation of the background search we're waiting for, None if
+        # we're not waiting for anything.
+        self.filter_generation = None
+        self.polling_filter_result = False
+
         # create the interface
         self.view = view.View(self.config, self.notes_list_model)
 
@@ -255,10 +292,6 @@ class Controller:
         self.notes_db.add_observer('synced:note', self.observer_notes_db_synced_note)
         self.notes_db.add_observer('change:note-status', self.observer_notes_db_change_note_status)
 
-        if self.config.simplenote_sync:
-            self.notes_db.add_observer('progress:sync_full', self.observer_notes_db_sync_full)
-            self.sync_full()
-
         # we want to be notified when the user does stuff
         self.view.add_observer('click:notelink',
                 self.observer_view_click_notelink)
@@ -300,6 +333,15 @@ class Controller:
         self.selected_note_idx = -1
         self.view.select_note(0)
 
+        if self.config.simplenote_sync:
+            self.notes_db.add_observer('progress:sync_full', self.observer_notes_db_sync_full)
+            # the notes we have can be used while this runs. it updates the
+            # notes list, so that has to be set up first.
+            self.sync_full()
+
+        if self.config.notes_as_txt:
+            self.view.after(self.TXT_POLL_INTERVAL_MS, self.poll_txt_changes)
+
     def get_selected_note_key(self):
         if self.selected_note_idx >= 0:
             return self.notes_list_model.list[self.selected_note_idx].key
@@ -320,6 +362,9 @@ class Controller:
         self.view.main_loop()
 
     def observer_notes_db_change_note_status(self, notes_db, evt_type, evt):
+        # the housekeeper checks if this note's row in the list is out of date
+        self.notes_list_model.mark_dirty(evt.key)
+
         skey = self.get_selected_note_key()
         if skey == evt.key:
             self.view.set_note_status(self.notes_db.get_note_status(skey))
@@ -333,6 +378,10 @@ class Controller:
         a sync that's more recent than our most recent mod to that note.
         """
 
+        if not 0 <= self.selected_note_idx < len(self.notes_list_model.list):
+            # e.g. a full sync in the background while the list is empty
+            return
+
         selected_note_o = self.notes_list_model.list[self.selected_note_idx]
         # if the note synced back matches our currently selected note,
         # we overwrite.
@@ -469,7 +518,8 @@ class Controller:
 
         if self.config.simplenote_sync:
             syncn = self.notes_db.get_sync_queue_len()
-            wfsn = self.notes_db.waiting_for_simplenote
+            wfsn = self.notes_db.waiting_for_simplenote or \
+                   self.notes_db.sync_full_job is not None
         else:
             syncn = wfsn = 0
 
@@ -532,11 +582,73 @@ class Controller:
             self.view.refresh_notes_list()
 
     def observer_view_change_entry(self, view, evt_type, evt):
+        # for each new evt.value coming in, we ask the notes_db to search in
+        # the background. a newer search cancels any search in progress.
+        self.filter_generation = self.notes_db.filter_notes_threaded(evt.value)
+
+        if not self.polling_filter_result:
+            self.polling_filter_result = True
+            self.view.after(self.FILTER_POLL_INTERVAL_MS, self.poll_filter_result)
+
+    def poll_filter_result(self):
+        """Check if the background search has delivered the list we're
+        waiting for. Called periodically via the Tk main loop.
+        """
+
+        if self.filter_generation is None:
+            # a synchronous update_notes_list() has come in between
+            self.polling_filter_result = False
+            return
+
+        o = self.notes_db.get_filter_result()
+        if o is not None and o.generation == self.filter_generation:
+            self.polling_filter_result = False
+            self.filter_generation = None
+
+            # notes can be deleted or get their server key while the
+            # search runs, their rows would have keys that don't exist.
+            notes = self.notes_db.notes
+            filtered_notes = [row for row in o.filtered_notes if row.key in notes]
+            self.set_filtered_notes(filtered_notes, o.match_regexp, o.active_notes)
+
+            if len(filtered_notes) != len(o.filtered_notes):
+                # a new search has the rekeyed notes under their new keys
+                self.view.refresh_notes_list()
+
+        else:
+            self.view.after(self.FILTER_POLL_INTERVAL_MS, self.poll_filter_result)
+
+    def poll_txt_changes(self):
+        """Apply changes that other programs made to the text files of the
+        notes. Called periodically via the Tk main loop.
+        """
+
+        if self.notes_db.process_txt_changes():
+            # new and deleted notes have to show up in the list
+            self.view.refresh_notes_list()
+
+        self.view.after(self.TXT_POLL_INTERVAL_MS, self.poll_txt_changes)
+
+    def update_notes_list(self):
+        """Synchronously filter notes with the current search string.
+
+        Used when the list has to be up to date right away, e.g. when we
+        want to select a note that has just been created.
+        """
+
+        # any background search that is still busy is out of date now.
+        self.filter_generation = None
+        nn, match_regexp, active_notes = self.notes_db.filter_notes(self.view.get_search_entry_text())
+        self.set_filtered_notes(nn, match_regexp, active_notes)
+
+    def set_filtered_notes(self, nn, match_regexp, active_notes):
+        """Put new list of notes in the notes list model, and try to keep
+        the current selection.
+        """
+
         # store the currently selected note key
         k = self.get_selected_note_key()
-        # for each new evt.value coming in, get a new list from the notes_db
-        # and set it in the notes_list_model
-        nn, match_regexp, active_notes = self.notes_db.filter_notes(evt.value)
+        # set the new list in the notes_list_model
         self.notes_list_model.set_list(nn)
         self.notes_list_model.match_regexp = match_regexp
         self.view.set_note_tally(len(nn), active_notes, len(self.notes_db.notes))
@@ -611,7 +723,8 @@ class Controller:
         if self.config.simplenote_sync:
             self.notes_db.sync_to_server_threaded(wait_for_idle=False)
             syncn = self.notes_db.get_sync_queue_len()
-            wfsn = self.notes_db.waiting_for_simplenote
+            wfsn = self.notes_db.waiting_for_simplenote or \
+                   self.notes_db.sync_full_job is not None
         else:
             syncn = wfsn = 0
 
@@ -624,9 +737,11 @@ class Controller:
             really_want_to_exit = self.view.askyesno("Confirm exit", msg)
 
             if really_want_to_exit:
+                self.notes_db.close()
                 self.view.close()
 
         else:
+            self.notes_db.close()
             self.view.close()
 
     def observer_view_create_note(self, view, evt_type, evt):
@@ -634,6 +749,8 @@ class Controller:
         new_key = self.notes_db.create_note(evt.title)
         # clear the search entry, this should trigger a new list being returned
         self.view.set_search_entry_text('')
+        # that list is computed in the background, but we need it now.
+        self.update_notes_list()
         # we should focus on our thingy
         idx = self.notes_list_model.get_idx(new_key)
         self.view.select_note(idx)
@@ -677,10 +794,29 @@ class Controller:
         self.view.unmute_note_data_changes()
 
     def sync_full(self):
+        """Start a full sync in the background, see poll_sync_full().
+        """
+
+        if self.notes_db.sync_full_threaded():
+            # notes that were sent by the sync thread get their server key
+            # when the full sync starts. the list has to show the new keys
+            # right away, the next keystroke edits the selected note.
+            self.update_notes_list()
+            self.view.after(self.SYNC_FULL_POLL_INTERVAL_MS, self.poll_sync_full)
+
+    def poll_sync_full(self):
+        """Show the progress of the background full sync, and the notes
+        list that results from it once it's done. Called periodically via
+        the Tk main loop.
+        """
+
         try:
-            sync_from_server_errors = self.notes_db.sync_full()
+            sync_errors = self.notes_db.sync_full_poll()
 
         except SyncError, e:
+            # the notes that were sent before the error have their server
+            # keys now
+            self.update_notes_list()
             self.view.show_error('Sync error', e)
         except WriteError, e:
             emsg = "Please check nvpy.log.\n" + str(e)
@@ -688,13 +824,20 @@ class Controller:
             exit(1)
 
         else:
+            if sync_errors is None:
+                # still busy
+                self.view.after(self.SYNC_FULL_POLL_INTERVAL_MS, self.poll_sync_full)
+                return
+
             # regenerate display list
             # reselect old selection
             # put cursor where it used to be.
-            self.view.refresh_notes_list()
+            # not in the background: keys could have changed, and the list
+            # must not refer to the old ones.
+            self.update_notes_list()
 
-            if sync_from_server_errors > 0:
-                self.view.show_error('Error syncing notes from server', 'Error syncing %d notes from server. Please check nvpy.log for details.' % (sync_from_server_errors,))
+            if sync_errors > 0:
+                self.view.show_error('Error syncing notes', 'Error syncing %d notes. Please check nvpy.log for details.' % (sync_errors,))
 
 
 def main():
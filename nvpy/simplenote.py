@@ -9,9 +9,16 @@
     :license: MIT, see LICENSE for more details.
 """
 
+import errno
+import httplib
+import socket
+from StringIO import StringIO
+from threading import Lock
+import time
 import urllib
 import urllib2
 from urllib2 import HTTPError
+import urlparse
 import base64
 try:
     import json
@@ -27,6 +34,155 @@ DATA_URL = 'https://simple-note.appspot.com/api2/data'
 INDX_URL = 'https://simple-note.appspot.com/api2/index?'
 NOTE_FETCH_LENGTH = 20
 
+class ConnectionPool(object):
+    """ Keep-alive HTTP(S) connections, so that consecutive requests don't
+    each need a new TCP connection and TLS handshake.
+
+    Thread-safe: every request takes an idle connection or opens a new
+    one, and gives it back afterwards. At most `max_idle` connections per
+    host are kept, and connections that have been idle for longer than
+    `max_idle_s` seconds are closed, the server has probably dropped them
+    by then.
+
+    Requests that have to go through a proxy from the environment, e.g.
+    https_proxy, are left to urllib2.
+    """
+
+    # like urllib2, only GET requests follow redirects
+    REDIRECT_CODES = (301, 302, 303, 307)
+    MAX_REDIRECTS = 10
+
+    def __init__(self, max_idle=4, max_idle_s=30, timeout=60):
+        self.max_idle = max_idle
+        self.max_idle_s = max_idle_s
+        self.timeout = timeout
+        self.lock = Lock()
+        # (scheme, host) -> list of (connection, time it was given back)
+        self.idle = {}
+
+    def _reap(self, now):
+        """ close connections that have been idle for too long, caller
+        holds the lock """
+        for conns in self.idle.values():
+            while conns and now - conns[0][1] > self.max_idle_s:
+                conns.pop(0)[0].close()
+
+    def _get(self, scheme, host):
+        with self.lock:
+            self._reap(time.time())
+            conns = self.idle.get((scheme, host))
+            if conns:
+                # the most recently used one is the least likely to be stale
+                return conns.pop()[0], True
+
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.timeout), False
+
+        return httplib.HTTPConnection(host, timeout=self.timeout), False
+
+    def _put(self, scheme, host, conn):
+        with self.lock:
+            now = time.time()
+            self._reap(now)
+            conns = self.idle.setdefault((scheme, host), [])
+            if len(conns) < self.max_idle:
+                conns.append((conn, now))
+                return
+
+        conn.close()
+
+    def request(self, url, data=None, method=None):
+        """ perform request and return the body of the response
+
+        Raises HTTPError if the server did not return 2xx, and another
+        IOError if the request failed.
+        """
+        if method is None:
+            method = 'GET' if data is None else 'POST'
+
+        headers = {}
+        if data is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        for i in xrange(self.MAX_REDIRECTS + 1):
+            scheme, host, path, query = urlparse.urlsplit(url)[:4]
+            proxies = urllib.getproxies()
+            if scheme in proxies and not urllib.proxy_bypass(host):
+                return self._urlopen(url, data, method, headers)
+
+            selector = path + ('?' + query if query else '')
+            response, body = self._send(scheme, host, method, selector, data, headers)
+
+            if response.status in self.REDIRECT_CODES and method == 'GET' and \
+               response.getheader('location'):
+                url = urlparse.urljoin(url, response.getheader('location'))
+                continue
+
+            if not 200 <= response.status < 300:
+                raise HTTPError(url, response.status, response.reason,
+                                response.msg, StringIO(body))
+
+            return body
+
+        raise HTTPError(url, response.status, 'Too many redirects',
+                        response.msg, StringIO(body))
+
+    def _urlopen(self, url, data, method, headers):
+        """ perform request with urllib2, which handles proxies and
+        redirects itself, without keeping the connection """
+        response = urllib2.urlopen(Request(url, data, headers, method=method),
+                                   timeout=self.timeout)
+        try:
+            return response.read()
+
+        except (httplib.HTTPException, socket.error), e:
+            raise urllib2.URLError(e)
+
+        finally:
+            response.close()
+
+    def _send(self, scheme, host, method, selector, data, headers):
+        """ send request over a pooled connection, return the response
+        and its body """
+        while True:
+            conn, reused = self._get(scheme, host)
+            sent = False
+            try:
+                conn.request(method, selector, data, headers)
+                sent = True
+                response = conn.getresponse()
+                body = response.read()
+
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                # the server closes idle keep-alive connections whenever it
+                # likes, in which case it can't have seen our request. try
+                # again with a new connection. anything else, like a
+                # timeout, could mean that the server did get the request,
+                # and sending it again could e.g. create a note twice.
+                if reused and (isinstance(e, httplib.BadStatusLine) or
+                               not sent and isinstance(e, socket.error) and
+                               e.errno in (errno.ECONNRESET, errno.EPIPE)):
+                    continue
+
+                raise urllib2.URLError(e)
+
+            if response.will_close:
+                conn.close()
+
+            else:
+                self._put(scheme, host, conn)
+
+            return response, body
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn, t in conns:
+                    conn.close()
+
+            self.idle = {}
+
 class Simplenote(object):
     """ Class for interacting with the simplenote web service """
 
@@ -35,6 +191,12 @@ class Simplenote(object):
         self.username = urllib2.quote(username)
         self.password = urllib2.quote(password)
         self.token = None
+        # shared by all threads that use this instance
+        self.pool = ConnectionPool()
+
+    def close(self):
+        """ close the connections to the server that are kept open """
+        self.pool.close()
 
     def authenticate(self, user, password):
         """ Method to get simplenote auth token
@@ -49,9 +211,8 @@ class Simplenote(object):
         """
         auth_params = "email=%s&password=%s" % (user, password)
         values = base64.encodestring(auth_params)
-        request = Request(AUTH_URL, values)
         try:
-            res = urllib2.urlopen(request).read()
+            res = self.pool.request(AUTH_URL, values)
             token = urllib2.quote(res)
         except IOError: # no connection exception
             token = None
@@ -88,14 +249,13 @@ class Simplenote(object):
         # request note
         params = '/%s?auth=%s&email=%s' % (str(noteid), self.get_token(),
                                            self.username)
-        request = Request(DATA_URL+params)
         try:
-            response = urllib2.urlopen(request)
+            response = self.pool.request(DATA_URL+params)
         except HTTPError, e:
             return e, -1
         except IOError, e:
             return e, -1
-        note = json.loads(response.read())
+        note = json.loads(response)
         #use UTF-8 encoding
         if isinstance(note["content"], str):
             note["content"] = note["content"].encode('utf-8')
@@ -120,6 +280,9 @@ class Simplenote(object):
 
         """
 
+        # the fields are converted below, leave the caller's note alone.
+        note = note.copy()
+
         # use UTF-8 encoding
         # cpbotha: in both cases check if it's not unicode already
         # otherwise you get "TypeError: decoding Unicode is not supported"
@@ -138,10 +301,9 @@ class Simplenote(object):
                                               self.get_token(), self.username)
         else:
             url = '%s?auth=%s&email=%s' % (DATA_URL, self.get_token(), self.username)
-        request = Request(url, urllib.quote(json.dumps(note)))
         response = ""
         try:
-            response = urllib2.urlopen(request).read()
+            response = self.pool.request(url, urllib.quote(json.dumps(note)))
         except IOError, e:
             return e, -1
         return json.loads(response), 0
@@ -171,7 +333,7 @@ class Simplenote(object):
         else:
             return "No string or valid note.", -1
 
-    def get_note_list(self, qty=float("inf")):
+    def get_note_list(self, qty=float("inf"), since=None):
         """ function to get the note list
 
         The function can be passed an optional argument to limit the
@@ -180,6 +342,7 @@ class Simplenote(object):
 
         Arguments:
             - quantity (integer number): of notes to list
+            - since (float): only list notes modified after this time
 
         Returns:
             An array of note objects with all properties set except
@@ -199,10 +362,15 @@ class Simplenote(object):
         else:
             params = 'auth=%s&email=%s&length=%s' % (self.get_token(), self.username,
                                                  NOTE_FETCH_LENGTH)
+        if since is not None:
+            # repr(), str() would round to 12 digits, and could round up
+            since = '&since=%s' % (repr(since),)
+            params += since
+        else:
+            since = ''
         # perform initial HTTP request
         try:
-            request = Request(INDX_URL+params)
-            response = json.loads(urllib2.urlopen(request).read())
+            response = json.loads(self.pool.request(INDX_URL+params))
             notes["data"].extend(response["data"])
         except IOError:
             status = -1
@@ -213,15 +381,16 @@ class Simplenote(object):
                 vals = (self.get_token(), self.username, response["mark"], qty - len(notes["data"]))
             else:
                 vals = (self.get_token(), self.username, response["mark"], NOTE_FETCH_LENGTH)
-            params = 'auth=%s&email=%s&mark=%s&length=%s' % vals
+            params = 'auth=%s&email=%s&mark=%s&length=%s' % vals + since
 
             # perform the actual HTTP request
             try:
-                request = Request(INDX_URL+params)
-                response = json.loads(urllib2.urlopen(request).read())
+                response = json.loads(self.pool.request(INDX_URL+params))
                 notes["data"].extend(response["data"])
             except IOError:
                 status = -1
+                # the same request would fail again
+                break
 
         # parse data fields in response
         ret = notes["data"]
@@ -270,9 +439,8 @@ class Simplenote(object):
 
         params = '/%s?auth=%s&email=%s' % (str(note_id), self.get_token(),
                                            self.username)
-        request = Request(url=DATA_URL+params, method='DELETE')
         try:
-            urllib2.urlopen(request)
+            self.pool.request(DATA_URL+params, method='DELETE')
         except IOError, e:
             return e, -1
         return {}, 0
@@ -0,0 +1,271 @@
+# nvPY: cross-platform note-taking app with simplenote syncing
+# copyright 2012 by Charl P. Botha <cpbotha@vxlabs.com>
+# new BSD license
+
+"""Watch the directory with the text versions of the notes for changes
+made by other programs.
+
+A watcher only reports which files could have changed, the main thread
+checks the files themselves, see NotesDB.process_txt_changes(). On Linux
+we use inotify, everywhere else we poll the directory.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+from Queue import Queue, Empty
+import select
+import struct
+import sys
+from threading import Thread
+import time
+
+# only these files are notes
+TXT_EXTENSIONS = ('.txt', '.mkdn')
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+
+IN_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+# struct inotify_event without the name that follows it
+inotify_event = struct.Struct('iIII')
+
+try:
+    if not sys.platform.startswith('linux'):
+        raise OSError('inotify is only available on Linux')
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    inotify_init = libc.inotify_init
+    inotify_add_watch = libc.inotify_add_watch
+
+except (OSError, AttributeError):
+    HAVE_INOTIFY = False
+
+else:
+    HAVE_INOTIFY = True
+    inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+def is_txt_name(name):
+    return os.path.splitext(name)[1] in TXT_EXTENSIONS
+
+class TxtWatcher:
+    """Base class of the watchers.
+
+    The watcher thread puts events on a queue, which the main thread
+    empties with get_events(). Events are tuples:
+
+     - ('changed', name): file name was written or created.
+     - ('deleted', name): file name was deleted.
+     - ('renamed', old_name, new_name): a file was renamed.
+     - ('rescan',): we lost track, all files have to be checked.
+
+    Names are unicode file names relative to the watched directory.
+    """
+
+    def __init__(self, path):
+        # so that os.listdir() also gives us unicode names
+        if not isinstance(path, unicode):
+            path = path.decode(sys.getfilesystemencoding() or 'utf-8')
+
+        self.path = path
+        self.q = Queue()
+
+    def start(self):
+        thread = Thread(target=self.worker)
+        thread.setDaemon(True)
+        thread.start()
+
+    def worker(self):
+        raise NotImplementedError
+
+    def get_events(self):
+        """Return list of all events that have come in since the previous
+        call, oldest first.
+        """
+
+        events = []
+        while True:
+            try:
+                events.append(self.q.get_nowait())
+
+            except Empty:
+                return events
+
+class InotifyWatcher(TxtWatcher):
+    """Watcher that gets its events from the Linux kernel.
+    """
+
+    READ_SIZE = 64 * 1024
+
+    # how long an IN_MOVED_FROM waits for its IN_MOVED_TO
+    MOVE_TIMEOUT_S = 0.1
+
+    def __init__(self, path):
+        TxtWatcher.__init__(self, path)
+
+        self.fd = inotify_init()
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        bpath = path.encode(sys.getfilesystemencoding() or 'utf-8') \
+                if isinstance(path, unicode) else path
+        if inotify_add_watch(self.fd, bpath, IN_WATCH_MASK) < 0:
+            e = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(e, os.strerror(e))
+
+    def worker(self):
+        # cookie -> name of an IN_MOVED_FROM that is waiting for its
+        # IN_MOVED_TO
+        moved_from = {}
+
+        while True:
+            try:
+                if moved_from and \
+                   not select.select([self.fd], [], [], self.MOVE_TIMEOUT_S)[0]:
+                    # moved out of the directory, that's a delete for us.
+                    for name in moved_from.values():
+                        self.q.put(('deleted', name))
+
+                    moved_from = {}
+
+                buf = os.read(self.fd, self.READ_SIZE)
+
+            except (OSError, select.error), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+
+                logging.error('TxtWatcher: Error reading inotify events: %s' % (str(e),))
+                return
+
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = inotify_event.unpack_from(buf, offset)
+                offset += inotify_event.size
+                name = buf[offset:offset + length].rstrip('\0')
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    self.q.put(('rescan',))
+                    continue
+
+                name = name.decode(sys.getfilesystemencoding() or 'utf-8', 'replace')
+                if mask & IN_MOVED_FROM:
+                    if is_txt_name(name):
+                        moved_from[cookie] = name
+
+                elif mask & IN_MOVED_TO:
+                    old_name = moved_from.pop(cookie, None)
+                    if not is_txt_name(name):
+                        if old_name is not None:
+                            self.q.put(('deleted', old_name))
+
+                    elif old_name is not None:
+                        self.q.put(('renamed', old_name, name))
+
+                    else:
+                        # e.g. an editor that writes a temporary file and
+                        # renames it over the note
+                        self.q.put(('changed', name))
+
+                elif is_txt_name(name):
+                    if mask & IN_DELETE:
+                        self.q.put(('deleted', name))
+
+                    else:
+                        self.q.put(('changed', name))
+
+class PollingWatcher(TxtWatcher):
+    """Watcher that compares the directory listing with the previous one
+    every POLL_INTERVAL_S seconds.
+    """
+
+    POLL_INTERVAL_S = 1
+
+    def __init__(self, path):
+        TxtWatcher.__init__(self, path)
+        self.files = self.scan()
+
+    def scan(self):
+        """Return dict mapping name to (inode, size, mtime) of all text
+        files in the directory.
+        """
+
+        files = {}
+        try:
+            names = os.listdir(self.path)
+
+        except OSError, e:
+            logging.error('TxtWatcher: Error listing %s: %s' % (self.path, str(e)))
+            return files
+
+        for name in names:
+            if not is_txt_name(name):
+                continue
+
+            try:
+                st = os.stat(os.path.join(self.path, name))
+
+            except OSError:
+                # gone again already
+                continue
+
+            files[name] = (st.st_ino, st.st_size, st.st_mtime)
+
+        return files
+
+    def worker(self):
+        while True:
+            time.sleep(self.POLL_INTERVAL_S)
+
+            files = self.scan()
+            old_files = self.files
+            self.files = files
+
+            gone = dict.fromkeys(name for name in old_files if name not in files)
+            # a renamed file keeps its inode. on windows, python always
+            # gives us 0 there.
+            gone_inodes = dict((old_files[name][0], name) for name in gone if old_files[name][0])
+            for name, st in files.items():
+                old_st = old_files.get(name)
+                if old_st is None:
+                    old_name = gone_inodes.pop(st[0], None) if st[0] else None
+                    if old_name is not None:
+                        del gone[old_name]
+                        self.q.put(('renamed', old_name, name))
+
+                    else:
+                        self.q.put(('changed', name))
+
+                elif old_st != st:
+                    self.q.put(('changed', name))
+
+            for name in gone:
+                self.q.put(('deleted', name))
+
+def open_watcher(path):
+    """Start and return the best watcher for directory path.
+    """
+
+    watcher = None
+    if HAVE_INOTIFY:
+        try:
+            watcher = InotifyWatcher(path)
+
+        except OSError, e:
+            # e.g. out of inotify instances
+            logging.warning('TxtWatcher: inotify not available, polling instead: %s' % (str(e),))
+
+    if watcher is None:
+        watcher = PollingWatcher(path)
+
+    watcher.start()
+    return watcher
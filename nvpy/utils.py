@@ -2,6 +2,7 @@
 # copyright 2012 by Charl P. Botha <cpbotha@vxlabs.com>
 # new BSD license
 
+import bisect
 import datetime
 import random
 import re
@@ -19,6 +20,11 @@ def generate_random_key():
     return '%030x' % (random.randrange(256**15),)
 
 def get_note_title(note):
+    # notes that are loaded lazily know their title without their content
+    title = getattr(note, 'title', None)
+    if title is not None:
+        return title
+
     mo = note_title_re.match(note.get('content', ''))
     if mo:
         return mo.groups()[0]
@@ -99,6 +105,30 @@ def note_markdown(n):
     else:
         return 0
 
+# simplenote sends these as strings, we keep them as numbers
+note_float_fields = ('createdate', 'modifydate', 'syncdate', 'savedate')
+note_int_fields = ('syncnum', 'version')
+
+def normalise_note(n):
+    """Convert the numeric fields of note n in place to float and int, so
+    that we don't have to parse them every time we compare them.
+
+    Has to be called on every note that comes from the server or from disc.
+    Returns n.
+    """
+
+    for f in note_float_fields:
+        v = n.get(f)
+        if isinstance(v, basestring):
+            n[f] = float(v)
+
+    for f in note_int_fields:
+        v = n.get(f)
+        if isinstance(v, basestring):
+            n[f] = int(v)
+
+    return n
+
 tags_illegal_chars = re.compile(r'[\s]')
 def sanitise_tags(tags):
     """
@@ -138,7 +168,61 @@ def sort_by_modify_date_pinned(a, b):
     elif not note_pinned(a.note) and note_pinned(b.note):
         return -1
     else:
-        return cmp(float(a.note.get('modifydate', 0)), float(b.note.get('modifydate', 0)))
+        return cmp(a.note.get('modifydate', 0), b.note.get('modifydate', 0))
+
+def keyed_diff(old, new, key):
+    """Compute the edits that turn list old into list new.
+
+    Items are matched on key(item). An item is kept in place if it is
+    equal to its match and its relative order is unchanged. We keep as many
+    items as possible (longest increasing subsequence), so everything else
+    is a minimal set of deletes and inserts. A moved item shows up as a
+    delete plus an insert.
+
+    @returns: (deletes, inserts) where deletes is a list of indices into old
+    in descending order, and inserts a list of indices into new in ascending
+    order. Apply the deletes first, then the inserts.
+    """
+
+    old_pos = {}
+    for i, o in enumerate(old):
+        old_pos[key(o)] = i
+
+    # for each item in new, the position of its unchanged match in old
+    matches = []
+    for j, n in enumerate(new):
+        i = old_pos.get(key(n))
+        if i is not None and old[i] == n:
+            matches.append((i, j))
+
+    # longest increasing subsequence of old positions, O(n log n)
+    tails = []
+    tails_idx = []
+    prev = [None] * len(matches)
+    for mi, (i, j) in enumerate(matches):
+        t = bisect.bisect_left(tails, i)
+        if t == len(tails):
+            tails.append(i)
+            tails_idx.append(mi)
+
+        else:
+            tails[t] = i
+            tails_idx[t] = mi
+
+        prev[mi] = tails_idx[t - 1] if t > 0 else None
+
+    kept_old = set()
+    kept_new = set()
+    mi = tails_idx[-1] if tails_idx else None
+    while mi is not None:
+        i, j = matches[mi]
+        kept_old.add(i)
+        kept_new.add(j)
+        mi = prev[mi]
+
+    deletes = [i for i in xrange(len(old) - 1, -1, -1) if i not in kept_old]
+    inserts = [j for j in xrange(len(new)) if j not in kept_new]
+    return deletes, inserts
 
 def check_internet_on():
     """Utility method to check if we have an internet connection.
@@ -194,20 +194,45 @@ class StatusBar(tk.Frame):
 
 class NotesList(tk.Frame):
     """
+    Only the rows that are visible, plus OVERSCAN rows above and below them,
+    are inserted into the Text widget. We drive the scrollbar ourselves, so
+    that it reflects the complete list.
+
     @ivar note_headers: list containing tuples with each note's title, tags,
-    modified date and so forth. Always in sync with what is displayed.
+    modified date and so forth. This is the backing store for all rows.
+    @ivar top_idx: index of the note in the top visible row.
+    @ivar rendered_start: index of the note in the first line of the Text
+    widget.
+    @ivar rendered_end: index of the note after the last line of the Text
+    widget.
+    @ivar rendered_date: the day on which the rows were rendered, after which
+    their human readable modification dates could be out of date.
     """
 
     TITLE_COL = 0
     TAGS_COL = 1
     MODIFYDATE_COL = 2
     PINNED_COL = 3
+    TAGFOUND_COL = 4
+    KEY_COL = 5
+
+    # number of extra rows rendered above and below the visible rows
+    OVERSCAN = 10
 
     def __init__(self, master, font_family, font_size, config):
         tk.Frame.__init__(self, master)
 
-        yscrollbar = tk.Scrollbar(self)
-        yscrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.selected_idx = -1
+        # list containing tuples with each note's title, tags,
+        self.note_headers = []
+
+        self.top_idx = 0
+        self.rendered_start = 0
+        self.rendered_end = 0
+        self.rendered_date = None
+
+        self.yscrollbar = tk.Scrollbar(self)
+        self.yscrollbar.pack(side=tk.RIGHT, fill=tk.Y)
 
         f = tkFont.Font(family=font_family, size=font_size)
         # tkFont.families(root) returns list of available font family names
@@ -216,7 +241,7 @@ class NotesList(tk.Frame):
         self.text = tk.Text(self, height=25, width=30,
             wrap=tk.NONE,
             font=f,
-            yscrollcommand=yscrollbar.set,
+            yscrollcommand=self.handler_text_yscroll,
             undo=True,
             background = config.background_color)
         # change default font at runtime with:
@@ -246,14 +271,10 @@ class NotesList(tk.Frame):
 
         self.text.tag_config("modifydate", foreground="dark gray")
 
-        yscrollbar.config(command=self.text.yview)
+        self.yscrollbar.config(command=self.cmd_yview)
 
         self._bind_events()
 
-        self.selected_idx = -1
-        # list containing tuples with each note's title, tags,
-        self.note_headers = []
-
         self.layout=config.layout
         self.print_columns=config.print_columns
         if bold_font.measure(' ') > f.measure(' '):
@@ -262,18 +283,24 @@ class NotesList(tk.Frame):
             self.cwidth = f.measure(' ')
         self.fonts = [f, italic_font, bold_font]
 
-    def append(self, note, config):
-        """
-        @param note: The complete note dictionary.
-        """
-
+    def _make_header(self, note, tagfound, key):
         title = utils.get_note_title(note)
         tags = note.get('tags')
         modifydate = float(note.get('modifydate'))
         pinned = utils.note_pinned(note)
-        self.note_headers.append((title, tags, modifydate, pinned))
+        return (title, tags, modifydate, pinned, tagfound, key)
 
-        self.enable_text()
+    def _insert_row(self, idx, index=tk.END):
+        """Insert the idx'th note as a new line at Text index, by default at
+        the end of the Text widget.
+        """
+
+        title, tags, modifydate, pinned, tagfound, key = self.note_headers[idx]
+
+        # right gravity keeps the mark after each piece that we insert
+        self.text.mark_set("row", index)
+        self.text.mark_gravity("row", tk.RIGHT)
+        index = "row"
 
         if self.layout == "vertical" and self.print_columns == 1:
             nrchars, rem = divmod((self.text.winfo_width()), self.cwidth)
@@ -282,36 +309,33 @@ class NotesList(tk.Frame):
             if pinned:
                 title += ' *'
 
-            self.text.insert(tk.END, u'{0:<{w}}'.format(title[:cellwidth-1], w=cellwidth), ("title,"))
+            self.text.insert(index, u'{0:<{w}}'.format(title[:cellwidth-1], w=cellwidth), ("title,"))
 
             if tags > 0:
-                if config.tagfound:
-                    self.text.insert(tk.END, u'{0:<{w}}'.format(','.join(tags)[:cellwidth-1], w=cellwidth), ("found",))
+                if tagfound:
+                    self.text.insert(index, u'{0:<{w}}'.format(','.join(tags)[:cellwidth-1], w=cellwidth), ("found",))
                 else:
-                    self.text.insert(tk.END, u'{0:<{w}}'.format(','.join(tags)[:cellwidth-1], w=cellwidth), ("tags",))
+                    self.text.insert(index, u'{0:<{w}}'.format(','.join(tags)[:cellwidth-1], w=cellwidth), ("tags",))
 
-            self.text.insert(tk.END, ' ' + utils.human_date(modifydate), ("modifydate",))
+            self.text.insert(index, ' ' + utils.human_date(modifydate), ("modifydate",))
 
             # tags can be None (newly created note) or [] or ['tag1', 'tag2']
         else:
-            self.text.insert(tk.END, title, ("title,"))
+            self.text.insert(index, title, ("title,"))
 
             if pinned:
-                self.text.insert(tk.END, ' *', ("pinned",))
+                self.text.insert(index, ' *', ("pinned",))
 
-            self.text.insert(tk.END, ' ' + utils.human_date(modifydate), ("modifydate",))
+            self.text.insert(index, ' ' + utils.human_date(modifydate), ("modifydate",))
 
             # tags can be None (newly created note) or [] or ['tag1', 'tag2']
             if tags > 0:
-                if config.tagfound:
-                    self.text.insert(tk.END, ' ' + ','.join(tags), ("found",))
+                if tagfound:
+                    self.text.insert(index, ' ' + ','.join(tags), ("found",))
                 else:
-                    self.text.insert(tk.END, ' ' + ','.join(tags), ("tags",))
-
-        self.text.insert(tk.END, '\n')
-
-        self.disable_text()
+                    self.text.insert(index, ' ' + ','.join(tags), ("tags",))
 
+        self.text.insert(index, '\n')
 
     def _bind_events(self):
         # Text widget events ##########################################
@@ -347,25 +371,51 @@ class NotesList(tk.Frame):
 
         self.text.bind("<Next>", cmd_pagedown)
 
+        # the number of visible rows could have changed
+        self.text.bind("<Configure>", lambda e: self.render())
+
 
     def cmd_text_button1(self, event):
         # find line that was clicked on
         text_index = self.text.index("@%d,%d" % (event.x, event.y))
         # go from event coordinate to tkinter text INDEX to note idx!
-        idx = int(text_index.split('.')[0]) - 1
+        idx = self.rendered_start + int(text_index.split('.')[0]) - 1
         self.select(idx, silent=False)
 
-
-    def clear(self):
+    def cmd_yview(self, *args):
+        """Handle the scrollbar, which works in terms of the complete list.
         """
 
+        n = self.get_number_of_notes()
+        visible_rows = self.get_visible_rows()
+
+        if args[0] == tk.MOVETO:
+            top_idx = int(round(float(args[1]) * n))
+
+        else:
+            # tk.SCROLL, number and then units or pages
+            delta = int(args[1])
+            if args[2] == tk.PAGES:
+                delta *= visible_rows
+
+            top_idx = self.top_idx + delta
+
+        self.scroll_to(top_idx)
+
+    def handler_text_yscroll(self, first, last):
+        """Called by the Text widget whenever its view changes.
+
+        The Text widget can scroll by itself, for example with the mouse wheel.
+        We keep track of this so we can render more rows when required.
         """
-        self.enable_text()
-        # clear everything from the display
-        self.text.delete(1.0, tk.END)
-        # and make sure our backing store is in sync
-        del self.note_headers[:]
-        self.disable_text()
+
+        line = int(self.text.index('@0,0').split('.')[0])
+        top_idx = self.rendered_start + line - 1
+        if top_idx != self.top_idx:
+            self.scroll_to(top_idx)
+
+        else:
+            self._update_scrollbar()
 
     def disable_text(self):
         self.text.config(state=tk.DISABLED)
@@ -390,8 +440,7 @@ class NotesList(tk.Frame):
         return idx
 
     def get_number_of_notes(self):
-        # could also have used:
-        # return int(self.text.index('end-1c').split('.')[0])
+        # the Text widget only contains the visible notes,
         # but we have the backing store!
         return len(self.note_headers)
 
@@ -415,19 +464,161 @@ class NotesList(tk.Frame):
         """
         return self.note_headers[idx][NotesList.MODIFYDATE_COL]
 
+    def get_visible_rows(self):
+        """
+        Return number of rows that fit in the Text widget.
+        """
+
+        linespace = max(f.metrics('linespace') for f in self.fonts)
+        return max(1, self.text.winfo_height() / linespace)
+
     def idx_to_index_range(self, idx):
         """
         Given a note index idx, return the Tkinter text index range for
-        the start and end of that note.
+        the start and end of that note. The note has to be rendered.
         """
 
         # tkinter text first line is 1, but first column is 0
-        row = idx+1
+        row = idx - self.rendered_start + 1
         start = "%d.0" % (row,)
         end = "%d.end" % (row,)
 
         return (start, end)
 
+    def render(self):
+        """
+        Fill the Text widget with the rows around top_idx.
+        """
+
+        n = self.get_number_of_notes()
+        visible_rows = self.get_visible_rows()
+        self.top_idx = max(0, min(self.top_idx, n - visible_rows))
+        self.rendered_start = max(0, self.top_idx - self.OVERSCAN)
+        self.rendered_end = min(n, self.top_idx + visible_rows + self.OVERSCAN)
+
+        self.enable_text()
+        self.text.delete(1.0, tk.END)
+        for idx in xrange(self.rendered_start, self.rendered_end):
+            self._insert_row(idx)
+
+        self.disable_text()
+        self.rendered_date = datetime.now().date()
+
+        self._tag_selected()
+        self._show_top()
+
+    def set_notes(self, notes):
+        """
+        Replace the complete list of notes.
+
+        Instead of rendering everything again, we compare the rows that are
+        in the Text widget with the rows that should be there, matching them
+        on note key, and only insert and delete the lines that differ. The
+        note at the top of the view stays there if it's still in the list.
+
+        @param notes: list of objects with key, note and tagfound attributes,
+        see NotesListModel.
+        """
+
+        old_headers = self.note_headers
+        self.note_headers = [self._make_header(o.note, o.tagfound, o.key)
+                             for o in notes]
+
+        new_idx = {}
+        for i, h in enumerate(self.note_headers):
+            new_idx[h[NotesList.KEY_COL]] = i
+
+        if 0 <= self.top_idx < len(old_headers):
+            self.top_idx = new_idx.get(old_headers[self.top_idx][NotesList.KEY_COL],
+                                       self.top_idx)
+
+        if 0 <= self.selected_idx < len(old_headers):
+            self.selected_idx = new_idx.get(old_headers[self.selected_idx][NotesList.KEY_COL], -1)
+
+        else:
+            self.selected_idx = -1
+
+        if self.rendered_date != datetime.now().date():
+            # the Text widget is out of date anyway
+            self.render()
+            return
+
+        old_rows = old_headers[self.rendered_start:self.rendered_end]
+
+        n = self.get_number_of_notes()
+        visible_rows = self.get_visible_rows()
+        self.top_idx = max(0, min(self.top_idx, n - visible_rows))
+        self.rendered_start = max(0, self.top_idx - self.OVERSCAN)
+        self.rendered_end = min(n, self.top_idx + visible_rows + self.OVERSCAN)
+        new_rows = self.note_headers[self.rendered_start:self.rendered_end]
+
+        deletes, inserts = utils.keyed_diff(old_rows, new_rows,
+                                            lambda h: h[NotesList.KEY_COL])
+
+        self.enable_text()
+        for row in deletes:
+            # tkinter text first line is 1
+            self.text.delete("%d.0" % (row + 1,), "%d.0" % (row + 2,))
+
+        for row in inserts:
+            self._insert_row(self.rendered_start + row, "%d.0" % (row + 1,))
+
+        self.disable_text()
+
+        self._tag_selected()
+        self._show_top()
+
+    def _tag_selected(self):
+        self.text.tag_remove("selected", "1.0", "end")
+        if self.rendered_start <= self.selected_idx < self.rendered_end:
+            start, end = self.idx_to_index_range(self.selected_idx)
+            self.text.tag_add("selected", start, end)
+
+    def scroll_to(self, top_idx):
+        """
+        Make note top_idx the top visible row.
+        """
+
+        n = self.get_number_of_notes()
+        visible_rows = self.get_visible_rows()
+        self.top_idx = max(0, min(top_idx, n - visible_rows))
+
+        # render new rows if we're getting close to either edge of what we
+        # have in the Text widget, otherwise we only have to scroll.
+        margin = self.OVERSCAN / 2
+        if (self.rendered_start > 0 and self.top_idx < self.rendered_start + margin) or \
+           (self.rendered_end < n and self.top_idx + visible_rows > self.rendered_end - margin):
+            self.render()
+
+        else:
+            self._show_top()
+
+    def see(self, idx):
+        """
+        Scroll so that note idx is visible.
+        """
+
+        visible_rows = self.get_visible_rows()
+        if idx < self.top_idx:
+            self.scroll_to(idx)
+
+        elif idx >= self.top_idx + visible_rows:
+            self.scroll_to(idx - visible_rows + 1)
+
+    def _show_top(self):
+        self.text.yview("%d.0" % (self.top_idx - self.rendered_start + 1,))
+        self._update_scrollbar()
+
+    def _update_scrollbar(self):
+        n = self.get_number_of_notes()
+        if n:
+            visible_rows = self.get_visible_rows()
+            self.yscrollbar.set(float(self.top_idx) / n,
+                                float(min(n, self.top_idx + visible_rows)) / n)
+
+        else:
+            self.yscrollbar.set(0.0, 1.0)
+
     def select(self, idx, silent=True):
         """
         @param idx: index of note to select. -1 if no selection.
@@ -437,13 +628,13 @@ class NotesList(tk.Frame):
         self.text.tag_remove("selected", "1.0", "end")
 
         if idx >= 0 and idx < self.get_number_of_notes():
+            # store the current idx
+            self.selected_idx = idx
+            # ensure that this is visible, this could render new rows.
+            self.see(idx)
             # then add it to the requested note line(s)
             start, end = self.idx_to_index_range(idx)
             self.text.tag_add("selected", start, end)
-            # ensure that this is visible
-            self.text.see(start)
-            # and store the current idx
-            self.selected_idx = idx
 
         else:
             self.selected_idx = -1
@@ -577,12 +768,17 @@ class TriggeredcompleteEntry(tk.Entry):
 class View(utils.SubjectMixin):
     """Main user interface class.
     """
+
+    # wait this long after the last keystroke in the search entry before
+    # firing the change:entry event.
+    SEARCH_DEBOUNCE_MS = 50
     
     def __init__(self, config, notes_list_model):
         utils.SubjectMixin.__init__(self)
         
         self.config = config
         self.taglist = None
+        self.search_entry_after_id = None
         
         notes_list_model.add_observer('set:list', self.observer_notes_list)
         self.notes_list_model = notes_list_model
@@ -604,6 +800,11 @@ class View(utils.SubjectMixin):
 
         self.search_entry.focus_set()
 
+    def after(self, ms, func):
+        """Call func after ms milliseconds from the Tk main loop.
+        """
+        return self.root.after(ms, func)
+
     def askyesno(self, title, msg):
         return tkMessageBox.askyesno(title, msg)
     
@@ -1163,77 +1364,73 @@ class View(utils.SubjectMixin):
         # nvPY will do saving and syncing!
         self.notify_observers('keep:house', None)
         
-        # check if titles need refreshing
+        # only notes that changed since the previous tick can have made the
+        # notes list out of date, so those are the only ones we check.
         refresh_notes_list = False
-        prev_title = None
-        prev_modifydate = None
-        prev_pinned = 0
-        for i,o in enumerate(self.notes_list_model.list):
-            # order should be the same as our listbox
-            nt = utils.get_note_title(o.note)
-            ot = self.notes_list.get_title(i)
-            # if we strike a note with an out-of-date title, redo.
-            if nt != ot:
-                logging.debug('title "%s" resync' % (nt,))
+        for key in self.notes_list_model.pop_dirty_keys():
+            idx = self.notes_list_model.get_idx(key)
+            if idx >= 0 and self.helper_notes_list_row_outdated(idx):
                 refresh_notes_list = True
                 break
 
-            # compare modifydate timestamp in our notes_list_model to what's displayed
-            # if these are more than 60 seconds apart, we want to update our
-            # mod-date display.
-            md = float(o.note.get('modifydate', 0))
-            omd = self.notes_list.get_modifydate(i)
-            if abs(md - omd) > 60:
-                # we log the title
-                logging.debug('modifydate "%s" resync' % (nt,))
-                refresh_notes_list = True
-                break
-
-            pinned = utils.note_pinned(o.note)
-            old_pinned = self.notes_list.get_pinned(i)
-            if pinned != old_pinned:
-                # we log the title
-                logging.debug('pinned "%s" resync' % (nt,))
-                refresh_notes_list = True
-                break
-
-            tags = o.note.get('tags', 0)
-            old_tags = self.notes_list.get_tags(i)
-            if tags != old_tags:
-                # we log the title
-                logging.debug('tags "%s" resync' % (nt,))
-                refresh_notes_list = True
-                break
-
-            if self.config.sort_mode == 0:
-                # alpha
-                if prev_title is not None and prev_title > nt:
-                    logging.debug("alpha resort triggered")
-                    refresh_notes_list = True
-                    break
-                
-                prev_title = nt
-                
-            else:
-
-                # we go from top to bottom, newest to oldest
-                # this means that prev_modifydate (above) needs to be larger
-                # than md (below). if it's not, re-sort.
-                if prev_modifydate is not None and prev_modifydate < md and \
-                   not prev_pinned:
-                    logging.debug("modifydate resort triggered")
-                    refresh_notes_list = True
-                    break
-                
-                prev_modifydate = md
-                if self.config.pinned_ontop:
-                    prev_pinned = utils.note_pinned(o.note)
-            
         if refresh_notes_list:
             self.refresh_notes_list()
         
         self.root.after(self.config.housekeeping_interval_ms, self.handler_housekeeper)
         
+    def helper_notes_list_row_outdated(self, idx):
+        """Determine if the idx'th row of the notes list no longer matches
+        its note, or if the note is now out of order with its neighbours.
+        """
+
+        nl = self.notes_list_model.list
+        note = nl[idx].note
+
+        nt = utils.get_note_title(note)
+        if nt != self.notes_list.get_title(idx):
+            logging.debug('title "%s" resync' % (nt,))
+            return True
+
+        # compare modifydate timestamp in our notes_list_model to what's displayed
+        # if these are more than 60 seconds apart, we want to update our
+        # mod-date display.
+        md = float(note.get('modifydate', 0))
+        if abs(md - self.notes_list.get_modifydate(idx)) > 60:
+            logging.debug('modifydate "%s" resync' % (nt,))
+            return True
+
+        if utils.note_pinned(note) != self.notes_list.get_pinned(idx):
+            logging.debug('pinned "%s" resync' % (nt,))
+            return True
+
+        if note.get('tags', 0) != self.notes_list.get_tags(idx):
+            logging.debug('tags "%s" resync' % (nt,))
+            return True
+
+        for a, b in ((idx - 1, idx), (idx, idx + 1)):
+            if a >= 0 and b < len(nl) and \
+               not self.helper_in_sort_order(nl[a].note, nl[b].note):
+                logging.debug('resort "%s" triggered' % (nt,))
+                return True
+
+        return False
+
+    def helper_in_sort_order(self, a, b):
+        """Determine if note a may be listed before note b, following
+        NotesDB.filter_notes().
+        """
+
+        if self.config.pinned_ontop and utils.note_pinned(a) != utils.note_pinned(b):
+            return utils.note_pinned(a)
+
+        if self.config.sort_mode == 0:
+            # alpha
+            return utils.get_note_title(a) <= utils.get_note_title(b)
+
+        else:
+            # newest to oldest
+            return float(a.get('modifydate', 0)) >= float(b.get('modifydate', 0))
+
     def handler_pinned_checkbutton(self, *args):
         self.notify_observers('change:pinned',
             utils.KeyValueObject(value=self.pinned_checkbutton_var.get()))
@@ -1254,6 +1451,16 @@ class View(utils.SubjectMixin):
             self.text_note.focus()
         
     def handler_search_entry(self, *args):
+        # this is called for every keystroke. we only fire the event when
+        # the user pauses typing, so that the search entry stays responsive.
+        if self.search_entry_after_id is not None:
+            self.root.after_cancel(self.search_entry_after_id)
+
+        self.search_entry_after_id = self.root.after(
+            self.SEARCH_DEBOUNCE_MS, self.handler_search_entry_idle)
+
+    def handler_search_entry_idle(self):
+        self.search_entry_after_id = None
         self.notify_observers('change:entry',
                               utils.KeyValueObject(value=self.search_entry_var.get()))
 
@@ -1475,8 +1682,8 @@ class View(utils.SubjectMixin):
     def set_notes(self, notes):
         # this method is called by View.observer_notes_list()
 
-        # clear the notes list
-        self.notes_list.clear()
+        # only the rows that changed are updated in the notes list
+        self.notes_list.set_notes(notes)
         taglist = []
 
         for o in notes:
@@ -1484,8 +1691,6 @@ class View(utils.SubjectMixin):
             if tags:
                 taglist += tags
 
-            self.notes_list.append(o.note, utils.KeyValueObject(tagfound=o.tagfound))
-
         if self.taglist is None:
             # first time we get called, so we need to initialise
             self.taglist = taglist